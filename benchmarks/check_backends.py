@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""Checks that all parser backends extract identical files from a corpus of generated folder
+and file details pages, variants of them with differently quoted attributes, attribute values
+containing ">" and upper case names, a hand-written page in the style of the legacy folder.php and any folder or details
+pages saved from a real Stud.IP instance given on the command line. Exits with a non-zero status
+on the first difference.
+
+    python3 -m benchmarks.check_backends [--folder PAGE.html ...] [--details PAGE.html ...]
+"""
+
+import re, sys, argparse
+
+from studip.parsers import PARSER_BACKENDS, parse_file_list, parse_file_list_details, \
+        parse_file_details, ParserError
+
+from .pages import generate_semester, render_folder_page
+
+
+TAG_RE = re.compile(r'''<(/?)([a-zA-Z][a-zA-Z0-9]*)((?:[^>"']|"[^"]*"|'[^']*')*)>''')
+TITLED_TAG_RE = re.compile(r'<(a|div|span|td)\b')
+ATTR_RE = re.compile(r'([a-zA-Z_:][-a-zA-Z0-9_:.]*)="([^"]*)"')
+UNQUOTED_RE = re.compile(r'[-a-zA-Z0-9_.:;?&=#%]+$')
+
+# Attributes as browsers and HTMLParser accept them, but as the generated pages never write them
+STYLES = [
+    ("single quotes", lambda name, value: "{}='{}'".format(name, value)),
+    ("unquoted", lambda name, value: "{}={}".format(name, value)
+            if UNQUOTED_RE.match(value) else '{}="{}"'.format(name, value)),
+    ("upper case", lambda name, value: '{}="{}"'.format(name.upper(), value)),
+    ("mixed", lambda name, value: "{} = {}".format(name.upper(), value)
+            if UNQUOTED_RE.match(value) else "{}\n='{}'".format(name, value)),
+]
+
+def add_titles(html):
+    # A ">" in a quoted attribute value does not end the tag
+    return TITLED_TAG_RE.sub(r'<\1 title="x > y"', html)
+
+def restyle(html, style, upper_tags):
+    def restyle_tag(match):
+        attrs = ATTR_RE.sub(lambda attr: style(attr.group(1), attr.group(2)), match.group(3))
+        name = match.group(2).upper() if upper_tags else match.group(2)
+        return "<" + match.group(1) + name + attrs + ">"
+    return TAG_RE.sub(restyle_tag, html)
+
+
+# Written after the folder.php of Stud.IP 2.x/3.x: tags spread over several lines, attributes in
+# different orders and quotings, comments and scripts mentioning file blocks, a nested folder
+# block and a file whose details are shown
+LEGACY_FOLDER_PAGE = """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN">
+<html>
+<head>
+  <title>Stud.IP - Dateien</title>
+  <script type='text/javascript'>
+    // STUDIP.Filesystem.openhoverfile('<div id="file_' + id + '_0">')
+    var x = "<div id='file_x_0'>";
+  </script>
+</head>
+<body id='folder'>
+<!-- <div id="file_commented_0"> -->
+<div id='layout_content'>
+<form method=post action='folder.php?cid=c0ffee&amp;cmd=all'>
+<div id=folder_0f1d_0 class='droppable' data-folder_id=0f1d>
+  <table class=default><tr><td class='printhead'>Allgemeiner Dateiordner</td></tr></table>
+<div
+    class='droppable'
+    id='file_5f8e2a_0' >
+  <table cellpadding=0 border=0 width="100%"><tr>
+    <td class=printhead valign=bottom>
+      <input type=checkbox name='download_ids[]' value=5f8e2a>
+      <a href='sendfile.php?type=0&amp;file_id=5f8e2a&amp;file_name=%DCbung+1.pdf'><img
+          src='assets/images/icons/16/blue/file-pdf.png' class=text-bottom alt=''></a>
+      <a href='folder.php?cid=c0ffee&amp;open=5f8e2a#anker' class=tree
+        ><span  style='font-weight:bold' id='file_5f8e2a_header'>&Uuml;bung 1 &amp; L&ouml;sung</span></a>
+      (121 KB / 4 Downloads)
+    </td>
+    <td class='printhead' nowrap align=right>
+      <a href='dispatch.php/profile?username=j.doe'>Jane Doe</a>
+      02.03.2017 - 14:05
+    </td>
+  </tr></table>
+  <div id='file_5f8e2a_body' class=printcontent>
+    <table><tr><td><a href='folder.php?cid=c0ffee&amp;open=0f1d#anker'>Allgemeiner Dateiordner / &Uuml;bungen</a></td></tr>
+    <tr><td>
+      <a class='button' href='sendfile.php?type=0&amp;file_id=5f8e2a&amp;file_name=%DCbung+1.pdf'>Herunterladen</a>
+      <a class=button href='sendfile.php?zip=1&amp;type=0&amp;file_id=5f8e2a&amp;file_name=%DCbung+1.pdf'>als ZIP-Archiv</a>
+    </td></tr></table>
+    <div class='messagebox messagebox_info'>Urheberrechtlich gesch&uuml;tzt</div>
+  </div>
+</div>
+<DIV ID=file_a9c_0 CLASS=droppable>
+  <TABLE><TR>
+    <TD CLASS=printhead>
+      <A HREF="sendfile.php?type=0&amp;file_id=a9c&amp;file_name=folien.tar.gz"><IMG SRC="x.png"></A>
+      <A HREF="folder.php?cid=c0ffee&amp;open=a9c#anker"><SPAN ID="file_a9c_header" STYLE="font-weight: bold">Folien</SPAN></A>
+    </TD>
+    <TD CLASS=printhead><A HREF="dispatch.php/profile?username=max">Max M&uuml;ller</A> 10.10.2016 - 08:00</TD>
+  </TR></TABLE>
+</DIV>
+<div data-id='file_decoy_0' class=droppable><a href='sendfile.php?type=0&amp;file_id=decoy&amp;file_name=decoy'>decoy</a></div>
+<div id='file_7_0'><table><tr><td><a href='sendfile.php?type=0&amp;file_id=7&amp;file_name=README'>x</a>
+  <span id='file_7_header' style="font-weight: bold">README</span></td>
+  <td><a href='dispatch.php/profile?username=a'>A</a> 31.12.2016 - 23:59</td></tr></table></div>
+</div>
+</form>
+</div>
+</body>
+</html>
+"""
+
+
+def generate_corpus():
+    # Collapsed, partially expanded and fully expanded listings of courses of different sizes
+    for seed, n_files in enumerate([ 0, 1, 10, 100 ]):
+        for course in generate_semester(n_courses=2, n_files=n_files, seed=seed):
+            yield "folder", course.id, render_folder_page(course)
+            yield "folder", course.id, render_folder_page(course, expanded=True)
+            for file in course.files[:10]:
+                yield "details", course.id, render_folder_page(course, open_id=file.id)
+
+    yield "folder", "empty", "<html><body>Keine Dateien vorhanden</body></html>"
+    yield "details", "empty", "<html><body>Keine Dateien vorhanden</body></html>"
+    yield "folder", "legacy", LEGACY_FOLDER_PAGE
+    yield "details", "legacy", LEGACY_FOLDER_PAGE
+
+
+def generate_variants(corpus):
+    for page_type, course_id, page in corpus:
+        for titled in [ False, True ]:
+            html = add_titles(page) if titled else page
+            course_id_titled = course_id + (" (titles)" if titled else "")
+            yield page_type, course_id_titled, html
+            for name, style in STYLES:
+                yield page_type, "{} ({})".format(course_id_titled, name), \
+                        restyle(html, style, upper_tags=name in [ "upper case", "mixed" ])
+
+
+def load_pages(page_type, file_names):
+    for file_name in file_names:
+        with open(file_name, "rb") as file:
+            yield page_type, file_name, file.read().decode("utf-8", "replace")
+
+
+def describe(result):
+    if isinstance(result, Exception):
+        return repr(result)
+    elif isinstance(result, (list, tuple)):
+        return [ describe(item) for item in result ]
+    elif hasattr(result, "__dict__"):
+        return sorted(result.__dict__.items())
+    return result
+
+
+def parse(page_type, course_id, html, backend):
+    try:
+        if page_type == "folder":
+            return (parse_file_list(html, backend),
+                    parse_file_list_details(course_id, html, backend))
+        return parse_file_details(course_id, html, backend)
+    except ParserError as e:
+        return e
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--folder", nargs="+", default=[], metavar="PAGE",
+            help="folder pages saved from a Stud.IP instance")
+    arg_parser.add_argument("--details", nargs="+", default=[], metavar="PAGE",
+            help="pages showing the details of a file saved from a Stud.IP instance")
+    args = arg_parser.parse_args()
+
+    corpus = list(generate_corpus())
+    corpus += load_pages("folder", args.folder)
+    corpus += load_pages("details", args.details)
+
+    reference = PARSER_BACKENDS[0]
+    n_pages = 0
+    for page_type, course_id, html in generate_variants(corpus):
+        expected = describe(parse(page_type, course_id, html, reference))
+        for backend in PARSER_BACKENDS[1:]:
+            actual = describe(parse(page_type, course_id, html, backend))
+            if actual != expected:
+                print("{} page of {}: {} backend differs from {}".format(page_type, course_id,
+                        backend, reference))
+                print("expected: {}\nactual:   {}".format(expected, actual))
+                sys.exit(1)
+        n_pages += 1
+
+    print("All {} backends agree on {} pages".format(len(PARSER_BACKENDS), n_pages))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Measures how fast files are added to a large database, how fast fetched files are marked with
+different commit intervals, how fast Database.list_files(full=True) materializes the files
+again and how much of the latter is spent decoding folder paths, compared to decoding paths
+stored as the string representation of a python list with ast.literal_eval, as schema versions
+up to 15 did.
+
+    python3 -m benchmarks.database [--files 100000] [--courses 50] [--depth 3] [--fetched 2000]
+        [--commit-intervals 1 50]
+"""
+
+import os, ast, time, random, shutil, argparse, tempfile
+
+from datetime import datetime
+
+from studip.database import Database, Semester, Course, File, SyncMode, decode_path
+
+
+def populate(db, n_files, n_courses, depth, seed=0):
+    rng = random.Random(seed)
+    db.update_semester_list([ Semester("semester", "WS 16/17", 0) ])
+    for c in range(n_courses):
+        db.add_course(Course("course{}".format(c), "WS 16/17", str(c), "Course {}".format(c),
+                type="Lecture", sync=SyncMode.Full))
+    # Files are added course by course, like the update stage does
+    courses = [ [] for c in range(n_courses) ]
+    for i in range(n_files):
+        path = [ "Allgemeiner Dateiordner" ] + [ "Folder {}".format(rng.randrange(3))
+                for level in range(rng.randrange(depth + 1)) ]
+        courses[i % n_courses].append(File("file{}".format(i), "course{}".format(i % n_courses),
+                path=path, name="File {}".format(i), extension="pdf", author="Author",
+                description="File {}".format(i), remote_date=datetime(2017, 3, 2)))
+    for files in courses:
+        db.add_files(files)
+        db.commit()
+
+
+def set_local_dates(db, files, commit_interval):
+    # Like the fetch stage, which commits the local dates of fetched files in batches
+    for i in range(0, len(files), commit_interval):
+        batch = files[i:i + commit_interval]
+        for file in batch:
+            file.local_date = datetime.now()
+        db.set_local_dates(batch)
+        db.commit()
+
+
+def best_of(function, rounds=3):
+    best = None
+    for round in range(rounds):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--files", type=int, default=100000)
+    arg_parser.add_argument("--courses", type=int, default=50)
+    arg_parser.add_argument("--depth", type=int, default=3,
+            help="maximum number of folders below the course's root folder")
+    arg_parser.add_argument("--fetched", type=int, default=2000,
+            help="number of files marked as fetched for each commit interval")
+    arg_parser.add_argument("--commit-intervals", type=int, nargs="+", default=[ 1, 50 ])
+    args = arg_parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp(prefix="studip-benchmark-")
+    try:
+        db = Database(os.path.join(temp_dir, "cache.sqlite"))
+        statements = [ 0 ]
+        def count_statement(sql):
+            statements[0] += 1
+        db.conn.set_trace_callback(count_statement)
+        start = time.perf_counter()
+        populate(db, args.files, args.courses, args.depth)
+        elapsed = time.perf_counter() - start
+        db.conn.set_trace_callback(None)
+        print("Created {} files in {} courses in {:.1f} s, {:.2f} statements per file".format(
+                args.files, args.courses, elapsed, statements[0] / args.files))
+
+        elapsed = best_of(lambda: db.list_files(full=True))
+        print("{:<32} {:>9.3f} s {:>12.0f} files/s".format("list_files(full=True)", elapsed,
+                args.files / elapsed))
+
+        files = db.list_files(full=True)[:args.fetched]
+        for commit_interval in args.commit_intervals:
+            elapsed = best_of(lambda: set_local_dates(db, files, commit_interval), rounds=1)
+            print("{:<32} {:>9.3f} s {:>12.0f} files/s".format("set_local_dates, commit every {}"
+                    .format(commit_interval), elapsed, len(files) / elapsed))
+
+        paths = [ file.path for file in db.list_files(full=True) ]
+        encoded = [ "\x1f".join(path) for path in paths ]
+        literals = [ repr(path) for path in paths ]
+        for name, decode, values in [ ("paths with decode_path", decode_path, encoded),
+                ("paths with ast.literal_eval", ast.literal_eval, literals) ]:
+            elapsed = best_of(lambda: [ decode(value) for value in values ])
+            print("{:<32} {:>9.3f} s {:>12.0f} files/s".format(name, elapsed,
+                    args.files / elapsed))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
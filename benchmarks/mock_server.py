@@ -0,0 +1,243 @@
+"""A stand-in for the parts of Stud.IP and its SSO identity provider that studip-client talks
+to: the login and SAML flow, my_courses/set_semester, seminar_main.php, folder.php with cmd=all,
+open= and ZIP archives, and sendfile.php with range requests. Courses and files are generated by
+benchmarks.pages. Latency and server errors can be injected to exercise retries and the
+throttle.
+
+    python3 -m benchmarks.mock_server [--port 8080] [--courses 5] [--files 20]
+
+and then set studip_base and sso_base to the printed URLs. The login is user / secret.
+"""
+
+import io, re, time, random, zipfile, argparse, threading, socketserver
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit, parse_qs
+
+from .pages import generate_semester, render_folder_page, render_overview, make_id, \
+        LOGIN_PAGE, LOGIN_FAILED_PAGE, SAML_PAGE
+
+
+class MockStudIPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """Serves the given courses. Every request waits for latency seconds, and a share of
+    error_rate of the Stud.IP requests fail with "503 Service Unavailable". With expanded, folder
+    pages list the details of all files, which saves the client the details requests."""
+
+    daemon_threads = True
+
+    def __init__(self, courses, address=("127.0.0.1", 0), user_name="user", password="secret",
+            latency=0.0, error_rate=0.0, expanded=False):
+        super().__init__(address, MockStudIPHandler)
+        self.courses = dict((c.id, c) for c in courses)
+        self.files = dict((f.id, (c, f)) for c in courses for f in c.files)
+        self.user_name = user_name
+        self.password = password
+        self.latency = latency
+        self.error_rate = error_rate
+        self.expanded = expanded
+        self.rng = random.Random(0)
+        self.lock = threading.Lock()
+        self.idp_sessions = set()
+        self.studip_sessions = {}
+        self.requests = 0
+        self.bytes_sent = 0
+        self.paths = {}
+        self.archives = {}
+
+    @property
+    def studip_base(self):
+        return "http://127.0.0.1:{}".format(self.server_port)
+
+    @property
+    def sso_base(self):
+        return "http://localhost:{}".format(self.server_port)
+
+    def handle_error(self, request, client_address):
+        # Clients intentionally hang up early on seminar_main.php
+        pass
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.paths = {}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MockStudIPHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which would otherwise delay small responses
+    # until the client acknowledges the headers
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def cookies(self):
+        return SimpleCookie(self.headers.get("Cookie", ""))
+
+    def send(self, status, body=b"", headers={}, cookies={}):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        for key, value in cookies.items():
+            self.send_header("Set-Cookie", "{}={}; Path=/".format(key, value))
+        if "Content-Type" not in headers:
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytes_sent += len(body)
+
+    def read_form(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return parse_qs(self.rfile.read(length).decode("utf-8"))
+
+    def studip_session(self):
+        cookie = self.cookies().get("Seminar_Session")
+        if cookie is None:
+            return None
+        return self.server.studip_sessions.get(cookie.value)
+
+    def handle_request(self, method):
+        server = self.server
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        with server.lock:
+            server.requests += 1
+            server.paths[url.path] = server.paths.get(url.path, 0) + 1
+            fail = server.error_rate and server.rng.random() < server.error_rate
+        if url.path == "/studip/seminar_main.php":
+            # The client does not wait for this response, so the context is switched right away
+            session = self.studip_session()
+            if session is not None:
+                session["course"] = query.get("auswahl", [None])[0]
+        if server.latency:
+            time.sleep(server.latency)
+        form = self.read_form() if method == "POST" else {}
+        if fail and url.path not in [ "/studip/index.php", "/Shibboleth.sso/SAML2/POST" ] \
+                and not url.path.startswith("/idp/"):
+            return self.send(503, "Service Unavailable")
+
+        if url.path == "/studip/index.php":
+            return self.send(302, headers={ "Location": server.sso_base
+                    + "/idp/profile/SAML2/Redirect/SSO?execution=e1s1" })
+        elif url.path.startswith("/idp/") and method == "GET":
+            idp = self.cookies().get("idp_session")
+            if idp is not None and idp.value in server.idp_sessions:
+                return self.send(200, SAML_PAGE.format(make_id("saml", idp.value)))
+            return self.send(200, LOGIN_PAGE)
+        elif url.path.startswith("/idp/"):
+            if form.get("j_username", [""])[0] == server.user_name \
+                    and form.get("j_password", [""])[0] == server.password:
+                idp = make_id("idp", time.time(), server.rng.random())
+                with server.lock:
+                    server.idp_sessions.add(idp)
+                return self.send(200, SAML_PAGE.format(make_id("saml", idp)),
+                        cookies={ "idp_session": idp })
+            return self.send(200, LOGIN_FAILED_PAGE)
+        elif url.path == "/Shibboleth.sso/SAML2/POST":
+            if "SAMLResponse" not in form:
+                return self.send(400, "Bad SAML response")
+            sid = make_id("studip", time.time(), server.rng.random())
+            with server.lock:
+                server.studip_sessions[sid] = { "course": None }
+            return self.send(200, "<html><body>Welcome</body></html>",
+                    cookies={ "Seminar_Session": sid })
+
+        session = self.studip_session()
+        if session is None:
+            return self.send(200, "<html><body>Please log in</body></html>")
+
+        if url.path == "/studip/dispatch.php/my_courses/set_semester":
+            return self.send(200, render_overview(server.courses.values()))
+        elif url.path == "/studip/dispatch.php/my_courses":
+            return self.send(200, render_overview(server.courses.values()))
+        elif url.path == "/studip/seminar_main.php":
+            return self.send(200, "<html><body>Course</body></html>")
+        elif url.path == "/studip/folder.php":
+            course = server.courses.get(query.get("cid", [None])[0])
+            # Like Stud.IP, only show files of the course selected through seminar_main.php
+            if course is None or session["course"] != course.id:
+                return self.send(200, "<html><body>No course selected</body></html>")
+            if method == "POST" and "download_selected" in form:
+                # Like Stud.IP, the archive is created on the server and then served via sendfile
+                buffer = io.BytesIO()
+                with zipfile.ZipFile(buffer, "w") as archive:
+                    for file in course.files:
+                        if file.id in form.get("download_ids[]", []):
+                            archive.writestr(file.file_name, file.content())
+                archive_id = make_id("archive", time.time(), server.rng.random())
+                with server.lock:
+                    server.archives[archive_id] = buffer.getvalue()
+                return self.send(302, headers={ "Location": server.studip_base
+                        + "/studip/sendfile.php?type=4&file_id={}&file_name=archive.zip"
+                        .format(archive_id) })
+            open_id = query.get("open", [None])[0]
+            # Visiting the folder resets the new files icon on the overview page
+            course.new_files = 0
+            return self.send(200, render_folder_page(course, open_id, server.expanded))
+        elif url.path == "/studip/sendfile.php":
+            file_id = query.get("file_id", [None])[0]
+            if file_id in server.archives:
+                return self.send(200, server.archives.pop(file_id),
+                        headers={ "Content-Type": "application/zip" })
+            entry = server.files.get(file_id)
+            if entry is None:
+                return self.send(404, "Not found")
+            content = entry[1].content()
+            match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+            if match and int(match.group(1)) < len(content):
+                start = int(match.group(1))
+                return self.send(206, content[start:], headers={
+                    "Content-Type": "application/octet-stream",
+                    "Content-Range": "bytes {}-{}/{}".format(start, len(content) - 1,
+                            len(content)) })
+            return self.send(200, content, headers={ "Content-Type": "application/octet-stream" })
+        return self.send(404, "Not found")
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--port", type=int, default=8080)
+    arg_parser.add_argument("--courses", type=int, default=5)
+    arg_parser.add_argument("--files", type=int, default=20)
+    arg_parser.add_argument("--file-size", type=int, default=64 * 1024)
+    arg_parser.add_argument("--latency", type=float, default=0.0)
+    arg_parser.add_argument("--error-rate", type=float, default=0.0)
+    arg_parser.add_argument("--expanded", action="store_true")
+    args = arg_parser.parse_args()
+
+    courses = generate_semester(args.courses, args.files, file_size=args.file_size)
+    server = MockStudIPServer(courses, address=("127.0.0.1", args.port), latency=args.latency,
+            error_rate=args.error_rate, expanded=args.expanded)
+    print("studip_base = {}\nsso_base = {}".format(server.studip_base, server.sso_base))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Generates pages that look like the ones served by Stud.IP, as far as the parsers in
+studip.parsers are concerned. All names, ids and dates are made up."""
+
+import random, hashlib
+
+from urllib.parse import quote
+from html import escape
+
+
+class FixtureFile:
+    def __init__(self, id, name, extension, description, author, date, path, size,
+            copyrighted=False):
+        self.id = id
+        self.name = name
+        self.extension = extension
+        self.description = description
+        self.author = author
+        self.date = date
+        self.path = path
+        self.size = size
+        self.copyrighted = copyrighted
+
+    @property
+    def file_name(self):
+        return self.name + ("." + self.extension if self.extension else "")
+
+    def content(self):
+        seed = hashlib.sha256(self.id.encode("ascii")).digest()
+        return (seed * (self.size // len(seed) + 1))[:self.size]
+
+
+class FixtureCourse:
+    def __init__(self, id, semester, number, name, type, files):
+        self.id = id
+        self.semester = semester
+        self.number = number
+        self.name = name
+        self.type = type
+        self.files = files
+        # Number of files added since the user last visited the folder
+        self.new_files = 0
+
+
+def make_id(*parts):
+    return hashlib.md5("/".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+# Some variation in names, so that escaping and decoding are exercised as well
+NAME_PARTS = [ "Übungsblatt", "Folien & Notizen", "Klausur <Lösung>", "Kapitel", "summary",
+        "Präsentation \"final\"", "slides", "Aufgabe" ]
+EXTENSIONS = [ "pdf", "pdf", "pdf", "zip", "tar.gz", "docx", "" ]
+
+
+def generate_semester(n_courses=5, n_files=20, n_folders=3, file_size=4096, seed=0):
+    rng = random.Random(seed)
+    courses = []
+    for c in range(n_courses):
+        files = []
+        for f in range(n_files):
+            folder = ["Allgemeiner Dateiordner"]
+            if n_folders > 1:
+                folder = folder + [ "Folder {}".format(rng.randrange(n_folders - 1)) ]
+            part = rng.choice(NAME_PARTS)
+            files.append(FixtureFile(make_id(seed, c, f), "{} {}_{}".format(part, c, f),
+                    rng.choice(EXTENSIONS), "{} {} of course {}".format(part, f, c),
+                    "Autor Ö. {}".format(c),
+                    "02.03.2017 - {:02}:{:02}".format(f // 60 % 24, f % 60), folder, file_size,
+                    copyrighted=rng.random() < 0.2))
+        courses.append(FixtureCourse(make_id(seed, c), "WS 16/17", "{:04}".format(c),
+                "Course {}".format(c), "Lecture", files))
+    return courses
+
+
+def render_file_block(course, file, expanded):
+    name = quote(file.file_name, encoding="iso-8859-1")
+    body = ""
+    if expanded:
+        body = ('<div id="file_{id}_body" class="printcontent"><table><tr><td>'
+                '<a href="folder.php?cid={cid}&amp;open={fid}#anker">{path}</a></td></tr>'
+                '<tr><td><a href="sendfile.php?type=0&amp;file_id={id}&amp;file_name={name}" '
+                'class="button">Herunterladen</a>'
+                '<a href="sendfile.php?zip=1&amp;type=0&amp;file_id={id}&amp;file_name={name}" '
+                'class="button">als ZIP-Archiv</a></td></tr></table>{copy}</div>').format(
+                id=file.id, cid=course.id, fid=make_id(file.path), name=name,
+                path=escape(" / ".join(file.path)),
+                copy='<div class="messagebox messagebox_info">Urheberrechtlich gesch&uuml;tzt'
+                        '</div>' if file.copyrighted else "")
+    return ('<div id="file_{id}_0" class="droppable"><table class="default"><tr>'
+            '<td class="printhead" valign="bottom"><input type="checkbox" '
+            'name="download_ids[]" value="{id}"><a href="sendfile.php?type=0&amp;file_id={id}'
+            '&amp;file_name={name}"><img src="assets/images/icons/16/blue/file-pdf.png" '
+            'class="text-bottom" alt=""></a><a href="folder.php?cid={cid}&amp;open={id}'
+            '#anker" class="tree"><span id="file_{id}_header" style="font-weight: bold">'
+            '{descr}</span></a> ({size} KB / {downloads} Downloads)</td>'
+            '<td class="printhead" align="right" nowrap><a href="dispatch.php/profile?'
+            'username={user}">{author}</a> {date}</td></tr></table>{body}</div>\n').format(
+            id=file.id, cid=course.id, name=name, descr=escape(file.description),
+            size=max(1, file.size // 1024), downloads=len(file.id) % 7,
+            user=quote(file.author.lower().replace(" ", ".")), author=escape(file.author),
+            date=file.date, body=body)
+
+
+def render_folder_page(course, open_id=None, expanded=False):
+    blocks = "".join(render_file_block(course, f, expanded or f.id == open_id)
+            for f in course.files if open_id is None or f.id == open_id)
+    return ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>Dateien</title>'
+            '<script src="assets/javascripts/application.js"></script></head><body>'
+            '<div id="layout_page"><ul id="tabs"><li><a href="seminar_main.php">&Uuml;bersicht'
+            '</a></li><li class="current"><a href="folder.php?cid={cid}&amp;cmd=tree">Dateien'
+            '</a></li></ul><div id="layout_content"><form method="post" '
+            'action="folder.php?cid={cid}&amp;cmd=all"><div id="files">{blocks}</div>'
+            '<button name="download_selected">Auswahl herunterladen</button></form></div>'
+            '</div></body></html>').format(cid=course.id, blocks=blocks)
+
+
+def render_overview(courses):
+    semesters = sorted(set(c.semester for c in courses))
+    options = "".join('<option value="{}">{}</option>'.format(make_id(s), s) for s in semesters)
+    rows = "".join('<tr><td></td><td><img></td><td>{number}</td><td>'
+            '<a href="seminar_main.php?auswahl={id}">{name} ({type})</a></td>'
+            '<td><a href="seminar_main.php?auswahl={id}&amp;redirect_to=folder.php&amp;cmd=tree">'
+            '<img src="assets/images/icons/16/{icon}/files.png" title="{title}"></a></td>'
+            '</tr>'.format(number=c.number, id=c.id, name=escape(c.name), type=escape(c.type),
+            icon="red/new" if c.new_files else "grey",
+            title="{} Dateien".format(len(c.files)) + (", {} neue".format(c.new_files)
+                    if c.new_files else "")) for c in courses)
+    return ('<html><body><a href="logout.php">Logout</a>'
+            '<form><select name="sem_select"><option value="current" selected>current</option>'
+            '<optgroup>{options}</optgroup></select></form>'
+            '<div id="my_seminars"><table><caption>{sem}</caption><thead><tr><th></th></tr></thead>'
+            '<tbody>{rows}</tbody></table></div></body></html>').format(
+            options=options, sem=escape(semesters[0] if semesters else ""), rows=rows)
+
+
+LOGIN_PAGE = ('<html><body><form action="/idp/profile/SAML2/Redirect/SSO?execution=e1s1" '
+        'method="post"><input name="j_username"></form></body></html>')
+LOGIN_FAILED_PAGE = ('<html><body><p class="form-error">Wrong user name or password</p>'
+        '<form action="/idp/profile/SAML2/Redirect/SSO?execution=e1s2" method="post"></form>'
+        '</body></html>')
+SAML_PAGE = ('<html><body><form action="/Shibboleth.sso/SAML2/POST" method="post">'
+        '<input type="hidden" name="RelayState" value="cookie:1234"/>'
+        '<input type="hidden" name="SAMLResponse" value="{}"/></form></body></html>')
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Measures the throughput of ParserPool for the pages parsed during update, with parsing done
+inline by the fetching threads and by 1, 2 and N worker processes.
+
+    python3 -m benchmarks.parse_processes [--threads 4] [--pages 64] [--files 300]
+"""
+
+import argparse, time
+
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
+
+from studip.parse_pool import ParserPool
+from studip.parsers import parse_file_list_details, parse_file_details
+
+from .pages import generate_semester, render_folder_page
+
+
+def generate_pages(n_pages, n_files):
+    courses = generate_semester(n_courses=n_pages, n_files=n_files)
+    folder_pages = [ (c.id, render_folder_page(c, expanded=True).encode("utf-8"))
+            for c in courses ]
+    detail_pages = [ (c.id, render_folder_page(c, open_id=f.id).encode("utf-8"))
+            for c in courses for f in c.files ]
+    return folder_pages, detail_pages
+
+
+def run(pool, n_threads, function, pages):
+    # The threads stand in for the workers of the session, which parse the pages they fetch
+    start = time.perf_counter()
+    with ThreadPoolExecutor(n_threads) as executor:
+        results = list(executor.map(lambda page: pool.parse(function, page[1], "utf-8",
+                page[0]), pages))
+    return time.perf_counter() - start, results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--threads", type=int, default=4)
+    arg_parser.add_argument("--pages", type=int, default=64)
+    arg_parser.add_argument("--files", type=int, default=300)
+    args = arg_parser.parse_args()
+
+    folder_pages, detail_pages = generate_pages(args.pages, args.files)
+    workloads = [
+        ("folder pages", parse_file_list_details, folder_pages),
+        ("detail pages", parse_file_details, detail_pages),
+    ]
+
+    print("{} threads, {} CPUs".format(args.threads, cpu_count()))
+    print("{:<14} {:>9} {:>10} {:>10} {:>8}".format("workload", "processes", "pages/s", "MB/s",
+            "speedup"))
+    for name, function, pages in workloads:
+        n_bytes = sum(len(page) for course, page in pages)
+        baseline = None
+        for processes in sorted(set([ 0, 1, 2, cpu_count() ])):
+            pool = ParserPool(processes)
+            try:
+                # Warm up, which also starts the worker processes
+                run(pool, args.threads, function, pages[:args.threads])
+                elapsed, results = run(pool, args.threads, function, pages)
+            finally:
+                pool.close()
+            baseline = baseline or elapsed
+            print("{:<14} {:>9} {:>10.1f} {:>10.2f} {:>7.2f}x".format(name,
+                    processes or "inline", len(pages) / elapsed, n_bytes / elapsed / 1e6,
+                    baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main()
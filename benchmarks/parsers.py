@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Measures the throughput and memory usage of every parse_* function in studip.parsers on a
+corpus of generated pages, for each parser backend where the function has several.
+
+    python3 -m benchmarks.parsers [--backends html scanner] [--filter folder] [--time 0.5]
+        [--save DIR]
+"""
+
+import argparse, os, time, tracemalloc
+
+from base64 import b64encode
+
+from studip.parsers import PARSER_BACKENDS, parse_login_form, parse_saml_form, \
+        parse_semester_list, parse_course_list, parse_file_indicators, \
+        parse_course_list_and_file_indicators, parse_overview, parse_file_list, \
+        parse_file_list_details, parse_file_details
+
+from .pages import generate_semester, render_folder_page, render_overview, LOGIN_PAGE, \
+        SAML_PAGE
+
+
+def generate_corpus():
+    """Returns (name, html) pairs of the pages parsed during login, course selection and update"""
+    courses = generate_semester(n_courses=30, n_files=10, seed=1)
+    overview = render_overview(courses)
+    corpus = [
+        ("login", LOGIN_PAGE),
+        ("saml", SAML_PAGE.format(b64encode(os.urandom(6 * 1024)).decode("ascii"))),
+        ("my_seminars", overview),
+    ]
+    for n_files in [ 10, 1000, 10000 ]:
+        course = generate_semester(n_courses=1, n_files=n_files, n_folders=10, seed=2)[0]
+        corpus.append(("folder_{}".format(n_files), render_folder_page(course)))
+        if n_files == 1000:
+            corpus.append(("folder_{}_expanded".format(n_files),
+                    render_folder_page(course, expanded=True)))
+        if n_files == 10:
+            corpus.append(("details", render_folder_page(course, open_id=course.files[3].id)))
+    return corpus
+
+
+# (function, page name prefix, takes a backend, takes a course id)
+FUNCTIONS = [
+    (parse_login_form, "login", False, False),
+    (parse_saml_form, "saml", False, False),
+    (parse_semester_list, "my_seminars", False, False),
+    (parse_course_list, "my_seminars", False, False),
+    (parse_file_indicators, "my_seminars", False, False),
+    (parse_course_list_and_file_indicators, "my_seminars", False, False),
+    (parse_overview, "my_seminars", False, False),
+    (parse_file_list, "folder", True, False),
+    (parse_file_list_details, "folder", True, True),
+    (parse_file_details, "details", True, True),
+]
+
+
+def make_call(function, html, backend, course_id):
+    args = ("course",) if course_id else ()
+    if backend:
+        return lambda: function(*args, html, backend=backend)
+    return lambda: function(*args, html)
+
+
+def measure_time(call, min_time):
+    # Repeat until min_time has passed and report the best of several rounds
+    n = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(n):
+            call()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 5:
+            break
+        n *= 2
+    best = elapsed
+    for round in range(4):
+        start = time.perf_counter()
+        for i in range(n):
+            call()
+        best = min(best, time.perf_counter() - start)
+    return best / n
+
+
+def measure_memory(call):
+    """Returns the peak and the retained size of the memory allocated by a single call"""
+    tracemalloc.start()
+    try:
+        result = call()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak, current
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--backends", nargs="+", choices=PARSER_BACKENDS,
+            default=PARSER_BACKENDS, help="the first backend is the baseline for the speedup")
+    arg_parser.add_argument("--filter", default="",
+            help="only run functions or pages whose name contains this string")
+    arg_parser.add_argument("--time", type=float, default=0.5,
+            help="approximate time spent measuring each combination in seconds")
+    arg_parser.add_argument("--save", metavar="DIR", help="also write the corpus to DIR")
+    args = arg_parser.parse_args()
+
+    corpus = generate_corpus()
+    if args.save:
+        os.makedirs(args.save, exist_ok=True)
+        for name, html in corpus:
+            with open(os.path.join(args.save, name + ".html"), "w", encoding="utf-8") as file:
+                file.write(html)
+
+    print("{:<38} {:<22} {:<8} {:>10} {:>8} {:>10} {:>10} {:>8}".format("function", "page",
+            "backend", "pages/s", "MB/s", "peak KB", "kept KB", "speedup"))
+    for function, prefix, has_backend, has_course in FUNCTIONS:
+        for page, html in corpus:
+            if not page.startswith(prefix) \
+                    or args.filter not in function.__name__ + " " + page:
+                continue
+            n_bytes = len(html.encode("utf-8"))
+            baseline = None
+            for backend in args.backends if has_backend else [ None ]:
+                call = make_call(function, html, backend, has_course)
+                elapsed = measure_time(call, args.time)
+                peak, kept = measure_memory(call)
+                baseline = baseline or elapsed
+                print("{:<38} {:<22} {:<8} {:>10.1f} {:>8.2f} {:>10.1f} {:>10.1f} {:>7.2f}x"
+                        .format(function.__name__, page, backend or "-", 1 / elapsed,
+                        n_bytes / elapsed / 1e6, peak / 1024, kept / 1024, baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main()
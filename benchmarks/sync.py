@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Measures update, fetch and sync end to end against benchmarks.mock_server at several levels
+of concurrency, reporting wall time, requests and bytes served. Each measurement starts with an
+empty sync directory; fetch is measured after an unmeasured update.
+
+    python3 -m benchmarks.sync [--levels 1 4 8] [--courses 10] [--files 30] [--latency 0.02]
+"""
+
+import os, sys, time, shutil, argparse, tempfile, builtins, contextlib
+
+from studip.application import Application
+from studip.database import Database
+from studip.session import Session
+from studip.views import ViewSynchronizer
+
+from .mock_server import MockStudIPServer
+from .pages import generate_semester
+
+
+def open_session(server, sync_dir, concurrency):
+    meta_dir = os.path.join(sync_dir, ".studip")
+    os.makedirs(meta_dir, exist_ok=True)
+
+    app = Application()
+    app.config_file_name = os.path.join(meta_dir, "studip.conf")
+    app.configure()
+    config = app.config
+    config["server", "studip_base"] = server.studip_base
+    config["server", "sso_base"] = server.sso_base
+    for key in [ "update_concurrency", "scan_concurrency", "fetch_concurrency" ]:
+        config["connection", key] = concurrency
+    config["connection", "adaptive_concurrency"] = False
+
+    db = Database(os.path.join(meta_dir, "cache.sqlite"))
+    return Session(config, db, server.user_name, server.password, sync_dir)
+
+
+def run_operation(session, operation):
+    if operation == "update":
+        session.update_metadata()
+    elif operation == "fetch":
+        session.fetch_files()
+    else:
+        session.sync(lambda: [ ViewSynchronizer(session.sync_dir, session.config, session.db,
+                view) for view in session.db.list_views(full=True) ])
+    session.db.commit()
+
+
+def measure(server, operation, concurrency):
+    sync_dir = tempfile.mkdtemp(prefix="studip-benchmark-")
+    try:
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            session = open_session(server, sync_dir, concurrency)
+            try:
+                if operation == "fetch":
+                    run_operation(session, "update")
+                server.reset_counters()
+                start = time.perf_counter()
+                run_operation(session, operation)
+                elapsed = time.perf_counter() - start
+            finally:
+                session.close()
+        return elapsed, server.requests, server.bytes_sent
+    finally:
+        shutil.rmtree(sync_dir, ignore_errors=True)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--levels", type=int, nargs="+", default=[ 1, 4, 8 ])
+    arg_parser.add_argument("--operations", nargs="+", choices=[ "update", "fetch", "sync" ],
+            default=[ "update", "fetch", "sync" ])
+    arg_parser.add_argument("--courses", type=int, default=10)
+    arg_parser.add_argument("--files", type=int, default=30)
+    arg_parser.add_argument("--file-size", type=int, default=64 * 1024)
+    arg_parser.add_argument("--latency", type=float, default=0.02,
+            help="delay of every response in seconds")
+    arg_parser.add_argument("--error-rate", type=float, default=0.0,
+            help="share of Stud.IP requests that fail with 503")
+    arg_parser.add_argument("--expanded", action="store_true",
+            help="list the details of all files on the folder pages")
+    args = arg_parser.parse_args()
+
+    # Accept every new course
+    builtins.input = lambda prompt="": "y"
+
+    courses = generate_semester(args.courses, args.files, file_size=args.file_size)
+    server = MockStudIPServer(courses, latency=args.latency, error_rate=args.error_rate,
+            expanded=args.expanded).start()
+    try:
+        print("{} courses, {} files of {} KB, {:.0f} ms latency".format(args.courses,
+                args.courses * args.files, args.file_size // 1024, args.latency * 1000))
+        print("{:<8} {:>11} {:>9} {:>9} {:>10} {:>9}".format("stage", "concurrency",
+                "time s", "requests", "MB", "MB/s"))
+        for operation in args.operations:
+            for concurrency in args.levels:
+                elapsed, requests, n_bytes = measure(server, operation, concurrency)
+                print("{:<8} {:>11} {:>9.2f} {:>9} {:>10.2f} {:>9.2f}".format(operation,
+                        concurrency, elapsed, requests, n_bytes / 1e6, n_bytes / elapsed / 1e6))
+                sys.stdout.flush()
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,13 @@
-import os, sys, appdirs, stat
+import os, sys, appdirs, stat, shutil, json, hashlib
 
 from getpass import getpass
 from base64 import b64encode, b64decode
 from errno import ENOENT
 
 from .config import Config
-from .database import Database, View, QueryError, SyncMode
-from .util import prompt_choice, expand_int_range, encrypt_password, decrypt_password, Charset, \
-        EscapeMode, ellipsize
+from .database import Database, ConnectionProfile, View, QueryError, SyncMode
+from .util import prompt_choice, expand_int_range, encrypt_password, decrypt_password, \
+        encrypt_data, decrypt_data, Charset, EscapeMode, ellipsize
 from .session import Session, SessionError, LoginError
 from .views import ViewSynchronizer
 
@@ -89,7 +89,28 @@ class Application:
         self.config = Config(self.config_file_name, {
                 ("server", "studip_base"): "https://studip.uni-passau.de",
                 ("server", "sso_base"): "https://sso.uni-passau.de",
-                ("connection", "update_concurrency"): 4
+                ("connection", "update_concurrency"): 4,
+                ("connection", "scan_concurrency"): 4,
+                ("connection", "fetch_concurrency"): 4,
+                ("connection", "adaptive_concurrency"): True,
+                ("connection", "initial_concurrency"): 4,
+                ("connection", "max_concurrency"): 8,
+                ("connection", "max_requests_per_second"): 0,
+                ("connection", "max_bytes_per_second"): 0,
+                ("connection", "connect_timeout"): 10,
+                ("connection", "read_timeout"): 60,
+                ("connection", "retries"): 3,
+                ("connection", "bulk_download_threshold"): 0,
+                ("update", "parse_processes"): 0,
+                ("update", "file_list_parser"): "html",
+                ("update", "file_details_parser"): "html",
+                ("update", "full_crawl_interval"): 24,
+                ("database", "commit_interval"): 50,
+                ("database", "journal_mode"): "wal",
+                ("database", "synchronous"): "normal",
+                ("database", "cache_size"): 16,
+                ("database", "mmap_size"): 256,
+                ("database", "temp_store"): "memory"
             })
 
 
@@ -123,26 +144,30 @@ class Application:
         if ("user", "password") in self.config:
             password = decrypt_password(user_secret, self.config["user", "password"])
 
+        cookies = None
+        if user_name is not None:
+            cookies = self.load_session_cookies(user_secret, user_name)
+
         while True:
             if user_name is None:
                 user_name = input("Stud.IP user name: ")
                 login_changed = True
 
-            if password is None:
-                password = getpass()
-                login_changed = True
-
             try:
+                # The password is only asked for if the stored session cannot be reused
                 self.session = Session(self.config, self.database, user_name, password,
-                        self.sync_dir)
+                        self.sync_dir, cookies=cookies, ask_password=getpass)
             except SessionError as e:
                 sys.stderr.write("\n{}\n".format(e))
                 if not isinstance(e, LoginError):
                     raise ApplicationExit()
-                user_name = password = None
+                user_name = password = cookies = None
             else:
                 break
 
+        if password is None and self.session.password is not None:
+            login_changed = True
+
         if login_changed:
             if ("user", "save_login") in self.config \
                     and self.config["user", "save_login"][0] in "ynu":
@@ -155,13 +180,55 @@ class Application:
 
             if save_login in "yu":
                 self.config["user", "user_name"] = user_name
-            if save_login == "y":
-                self.config["user", "password"] = encrypt_password(user_secret, password)
+            if save_login == "y" and self.session.password is not None:
+                self.config["user", "password"] = encrypt_password(user_secret,
+                        self.session.password)
+
+        self.user_secret = user_secret
+        self.save_session_cookies()
+
+
+    def session_file_name(self, user_name):
+        # Sessions are stored per server and user, next to the secret used to encrypt them
+        key = hashlib.sha1("{}\n{}".format(self.config["server", "studip_base"], user_name)
+                .encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, "session-" + key)
+
+
+    def load_session_cookies(self, user_secret, user_name):
+        try:
+            with open(self.session_file_name(user_name), "r", encoding="ascii") as file:
+                return json.loads(decrypt_data(user_secret, file.read().strip()))["cookies"]
+        except Exception:
+            return None
+
+
+    def save_session_cookies(self):
+        file_name = self.session_file_name(self.session.user_name)
+        # Sessions are only restored with a saved login, otherwise they are not kept on disk
+        if ("user", "save_login") in self.config and self.config["user", "save_login"][:1] == "n":
+            try:
+                os.remove(file_name)
+            except Exception as e:
+                if not (isinstance(e, IOError) and e.errno == ENOENT):
+                    self.print_io_error("Unable to remove", file_name, e)
+            return
+
+        data = json.dumps({ "cookies": self.session.export_cookies() })
+        try:
+            # Session cookies grant access to the account just like the password does
+            fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, "w", encoding="ascii") as file:
+                file.write(encrypt_data(self.user_secret, data) + "\n")
+        except Exception as e:
+            self.print_io_error("Unable to write to", file_name, e)
 
 
     def open_database(self):
+        profile = ConnectionProfile(*(self.config["database", key] for key in [ "journal_mode",
+                "synchronous", "cache_size", "mmap_size", "temp_store" ]))
         try:
-            self.database = Database(self.db_file_name)
+            self.database = Database(self.db_file_name, profile)
         except Exception as e:
             self.print_io_error("Unable to open database", self.db_file_name, e)
             raise ApplicationExit()
@@ -184,6 +251,17 @@ class Application:
             sync = ViewSynchronizer(self.sync_dir, self.config, self.database, view)
             sync.checkout()
 
+
+    def sync(self):
+        def open_views():
+            return [ ViewSynchronizer(self.sync_dir, self.config, self.database, view)
+                    for view in self.database.list_views(full=True) ]
+
+        try:
+            self.session.sync(open_views)
+        finally:
+            self.database.commit()
+
     def fuse(self):
         from studip.fs_driver import FUSEView
         from fuse import FUSE
@@ -200,16 +278,28 @@ class Application:
         FUSE(fuse_ops, path, nothreads=True, foreground=True)
 
     def clear_cache(self):
-        try:
-            os.remove(self.db_file_name)
-        except Exception as e:
-            if not (isinstance(e, IOError) and e.errno == ENOENT):
-                self.print_io_error("Unable to remove database file", self.db_file_name, e)
-                raise ApplicationExit()
+        # The write-ahead log and its index must not outlive the database
+        for file_name in [ self.db_file_name, self.db_file_name + "-wal",
+                self.db_file_name + "-shm" ]:
+            try:
+                os.remove(file_name)
+            except Exception as e:
+                if not (isinstance(e, IOError) and e.errno == ENOENT):
+                    self.print_io_error("Unable to remove database file", file_name, e)
+                    raise ApplicationExit()
+
+        shutil.rmtree(os.path.join(self.dot_dir, "http-cache"), ignore_errors=True)
 
         print("Cache cleared.")
 
 
+    def optimize_database(self):
+        size = os.path.getsize(self.db_file_name)
+        self.database.optimize(vacuum=self.command_line["vacuum"])
+        print("Database optimized, size {:.1f} MB (was {:.1f} MB)".format(
+                os.path.getsize(self.db_file_name) / 1e6, size / 1e6))
+
+
     def gc(self):
         files_dir = os.path.join(self.dot_dir, "files")
         removed_files = 0
@@ -382,9 +472,11 @@ class Application:
             "    update        Update course database from Stud.IP\n"
             "    fetch         Download missing files from known database\n"
             "    checkout      Checkout files into views\n"
-            "    sync          <update>, then <fetch>, then <checkout>\n"
+            "    sync          <update>, <fetch> and <checkout> as a pipeline\n"
             "    gc            Delete fetched files that are not checked out\n"
             "    clear-cache   Clear local course and file database\n"
+            "\nDatabase maintenance:\n"
+            "    db optimize [--vacuum]\n"
             "\nCommands for showing and modifying views:\n"
             "    view show [<name>]\n"
             "    view add <name> [<key> <value>]...\n"
@@ -417,12 +509,15 @@ class Application:
             return True
 
         plain = []
+        self.command_line["vacuum"] = False
         i = 0
         while i < len(args):
             if args[i].startswith("-"):
                 if args[i] == "-d" and i < len(args)-1:
                     self.command_line["sync_dir"] = args[i+1]
                     i += 1
+                elif args[i] == "--vacuum":
+                    self.command_line["vacuum"] = True
                 else:
                     return False
             else:
@@ -433,6 +528,9 @@ class Application:
         op = plain[0]
         plain = plain[1:]
 
+        if self.command_line["vacuum"] and op != "db":
+            return False
+
         if op in ["update", "fetch", "checkout", "sync", "clear-cache", "gc", "fuse", ]:
             if len(plain) > 0:
                 return False
@@ -455,6 +553,9 @@ class Application:
                             return False
                 else:
                     return False
+        elif op == "db":
+            if plain != [ "optimize" ]:
+                return False
         elif op == "course":
             if len(plain) < 1:
                 return False
@@ -496,7 +597,7 @@ class Application:
 
         op = self.command_line["operation"]
 
-        if op in [ "update", "fetch", "checkout", "sync", "view", "course", "fuse" ]:
+        if op in [ "update", "fetch", "checkout", "sync", "view", "course", "fuse", "db" ]:
             self.configure()
             with self.config:
                 self.open_database()
@@ -509,12 +610,20 @@ class Application:
                         elif op == "fetch":
                             self.fetch_files()
                         elif op == "sync":
-                            self.update_database()
-                            self.fetch_files()
-                            self.checkout()
+                            self.sync()
                     except SessionError as e:
                         sys.stderr.write("\n{}\n".format(e))
                         raise ApplicationExit()
+                    finally:
+                        # The workers are kept for all operations. Nothing is queued anymore
+                        # after a successful run, so aborting only matters on errors.
+                        self.session.close(drain=False)
+                        self.save_session_cookies()
+
+                    limiter = self.session.throttle.limiter
+                    if limiter:
+                        print("\nAdaptive concurrency settled at {} simultaneous requests "
+                                "(peak {})".format(limiter.concurrency, int(limiter.peak)))
 
                 elif op == "checkout":
                     self.checkout()
@@ -524,6 +633,8 @@ class Application:
                     self.edit_courses()
                 elif op == "fuse":
                     self.fuse()
+                elif op == "db":
+                    self.optimize_database()
         elif op == "clear-cache":
             self.clear_cache()
         elif op == "gc":
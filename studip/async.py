@@ -1,27 +1,64 @@
-import threading, ctypes
+import threading
 
 from multiprocessing import cpu_count
-from threading import Thread, Condition, Lock
+from threading import Thread, Condition, Lock, Event
+from concurrent.futures import Future, CancelledError
+from collections import deque
+from queue import Queue, Empty
 from copy import deepcopy
 
 
-class ExitThread(BaseException):
+class TaskAborted(Exception):
+    """Raised by long-running tasks that notice that the pool is being aborted"""
     pass
 
+class TaskFailure:
+    """Returned in place of a task's result if executing the task raised an exception"""
+    def __init__(self, task, exception):
+        self.task = task
+        self.exception = exception
+
+class TaskFuture(Future):
+    """The future result of a task deferred to a ThreadPool, which remembers the task itself"""
+    def __init__(self, task):
+        super().__init__()
+        self.task = task
+        self.yielded = False
+
+    def outcome(self):
+        if self.cancelled():
+            return TaskFailure(self.task, CancelledError())
+        exception = self.exception()
+        return TaskFailure(self.task, exception) if exception is not None else self.result()
+
 class ThreadPool:
-    def __init__(self, n_threads=cpu_count(), local_state={}):
-        self.threads = [ Thread(target=lambda i=i: self.thread_main(i, deepcopy(local_state)))
-                for i in range(n_threads) ]
-
-        self.queue = []
-        self.results = []
-        self.last_req_no = -1
-        self.last_finished_no = -1
-        self.done_at_no = -1
+    """Executes tasks on a fixed number of threads, each with its own copy of local_state.
+
+    Tasks are deferred in batches, a batch ends with a call to done(). Iterating over the pool
+    yields the results of the current batch, in the order the tasks complete or, with
+    results(ordered=True), in the order they were deferred. If max_queued is given, defer()
+    blocks while that many tasks are waiting to be executed.
+
+    The pool can be used for any number of batches until it is closed. Workers are stopped
+    cooperatively: closing the pool either lets them finish all queued tasks, or cancels the
+    queued tasks and sets local_state["aborting"], which long-running tasks should check."""
+
+    def __init__(self, n_threads=cpu_count(), local_state={}, max_queued=0):
+        # Daemon threads do not keep a second Ctrl+C from exiting while a request is stuck
+        self.threads = [ Thread(target=lambda i=i: self.thread_main(i, deepcopy(local_state)),
+                daemon=True) for i in range(n_threads) ]
+
+        self.queue = Queue(max_queued)
+        # Futures of the current batch that have not been yielded yet, in submission order and
+        # in completion order, respectively. Entries yielded through the other one are skipped.
+        self.submitted = deque()
+        self.completed = deque()
+        self.outstanding = 0
+        self.is_done = True
         self.lock = Lock()
-        self.thread_cv = Condition(self.lock)
         self.iter_cv = Condition(self.lock)
         self.exception = None
+        self.aborting = Event()
 
         for thread in self.threads:
             thread.start()
@@ -37,59 +74,104 @@ class ThreadPool:
 
     def thread_main(self, i, local_state):
         local_state["thread_no"] = i
-        self.init_thread(local_state)
+        local_state["aborting"] = self.aborting
         try:
+            self.init_thread(local_state)
             while True:
-                with self.lock:
-                    self.thread_cv.wait_for(lambda: self.queue)
-                    task = self.queue.pop(0)
-                result = self.execute_task(local_state, task)
-                with self.lock:
-                    self.results.append(result)
-                    self.last_finished_no += 1
-                    self.iter_cv.notify()
-        except ExitThread:
-            pass
+                future = self.queue.get()
+                if future is None:
+                    # Sentinel queued by close()
+                    break
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(self.execute_task(local_state, future.task))
+                except Exception as e:
+                    future.set_exception(e)
         except BaseException as e:
             with self.lock:
                 self.exception = e
+                self.iter_cv.notify_all()
         finally:
             self.cleanup_thread(local_state)
 
+    def task_completed(self, future):
+        with self.lock:
+            self.completed.append(future)
+            self.iter_cv.notify_all()
+
     def defer(self, task):
+        """Schedules a task for execution and returns its TaskFuture"""
+        future = TaskFuture(task)
         with self.lock:
-            self.done_at_no = -1
-            self.last_req_no += 1
-            self.queue.append(task)
-            self.thread_cv.notify()
+            self.is_done = False
+            self.outstanding += 1
+            self.submitted.append(future)
+        future.add_done_callback(self.task_completed)
+        self.queue.put(future)
+        return future
 
-    def __iter__(self):
+    def done(self):
+        """Marks the end of the current batch, iteration stops after its last result"""
+        with self.lock:
+            self.is_done = True
+            self.iter_cv.notify_all()
+
+    def futures(self, ordered=False):
+        """Yields the futures of the current batch once they are completed"""
         with self.lock:
-            while self.last_finished_no <= self.done_at_no:
-                self.iter_cv.wait_for(lambda: self.last_finished_no >= self.done_at_no
-                        or self.results or self.exception)
+            while True:
+                self.iter_cv.wait_for(lambda: self.exception or (self.is_done
+                        and self.outstanding == 0) or (ordered and self.submitted
+                        and self.submitted[0].done()) or (not ordered and self.completed))
                 if self.exception:
                     e = self.exception
                     self.exception = None
                     raise e
-                elif self.results:
-                    yield self.results.pop(0)
-                else:
-                    break
-        raise StopIteration()
+                elif self.is_done and self.outstanding == 0:
+                    return
+
+                primary, secondary = (self.submitted, self.completed) if ordered \
+                        else (self.completed, self.submitted)
+                future = primary.popleft()
+                if future.yielded:
+                    continue
+                future.yielded = True
+                self.outstanding -= 1
+                while secondary and secondary[0].yielded:
+                    secondary.popleft()
+
+                self.lock.release()
+                try:
+                    yield future
+                finally:
+                    self.lock.acquire()
+
+    def results(self, ordered=False):
+        """Yields the results of the current batch, or a TaskFailure for tasks that failed"""
+        for future in self.futures(ordered):
+            yield future.outcome()
 
-    def done(self):
-        with self.lock:
-            self.done_at_no = self.last_req_no
+    def __iter__(self):
+        return self.results()
 
-    def destroy(self):
+    def close(self, drain=True):
+        """Stops all workers once they have executed the queued tasks, or, unless drain is True,
+        once they have finished their current tasks"""
+        if not drain:
+            self.aborting.set()
+            while True:
+                try:
+                    future = self.queue.get_nowait()
+                except Empty:
+                    break
+                if future is not None:
+                    future.cancel()
+
+        # Every worker stops after taking one of the sentinels from the queue
         for thread in self.threads:
-            # raise ExitThread in every thread
-            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(thread.ident),
-                ctypes.py_object(ExitThread))
-        with self.lock:
-            # Wake up all waiting threads to handle exception
-            self.thread_cv.notify_all()
+            if thread.is_alive():
+                self.queue.put(None)
         for thread in self.threads:
             thread.join()
         if self.exception:
@@ -101,4 +183,4 @@ class ThreadPool:
         return self
 
     def __exit__(self, type, value, traceback):
-        self.destroy()
+        self.close(drain=type is None)
@@ -1,5 +1,6 @@
-import sqlite3, os, ast, shutil, re
+import sqlite3, os, shutil, re
 from enum import IntEnum
+from datetime import datetime
 
 from .util import EscapeMode, Charset, abbreviate_course_name, abbreviate_course_type
 
@@ -116,6 +117,72 @@ class View:
         return self.id and self.format and self.escape and self.charset
 
 
+# Folder paths are stored as the folder names joined by the ASCII unit separator
+PATH_SEPARATOR = "\x1f"
+
+def decode_path(path):
+    return path.split(PATH_SEPARATOR) if path else []
+
+
+class FolderPage:
+    def __init__(self, course, digest, files):
+        self.course = course
+        self.digest = digest
+        self.files = files
+
+
+class CourseState:
+    def __init__(self, course, files_state, crawled):
+        self.course = course
+        self.files_state = files_state
+        self.crawled = crawled
+
+
+FILE_LIST_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+def encode_file_list(files):
+    return "\n".join("{} {}".format(id, date.strftime(FILE_LIST_DATE_FORMAT))
+            for id, date in files)
+
+def decode_file_list(text):
+    files = []
+    for line in text.splitlines():
+        id, date = line.split(" ", 1)
+        files.append((id, datetime.strptime(date, FILE_LIST_DATE_FORMAT)))
+    return files
+
+
+class ConnectionProfile:
+    """SQLite settings applied to every connection. cache_size and mmap_size are in MiB."""
+
+    journal_modes = [ "delete", "truncate", "persist", "memory", "wal", "off" ]
+    synchronous_modes = [ "off", "normal", "full", "extra" ]
+    temp_stores = [ "default", "file", "memory" ]
+
+    def __init__(self, journal_mode="wal", synchronous="normal", cache_size=16, mmap_size=256,
+            temp_store="memory"):
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.temp_store = temp_store
+
+    def pragmas(self):
+        # PRAGMA values cannot be bound as parameters, so they are checked here
+        for name, value, choices in [ ("journal_mode", self.journal_mode, self.journal_modes),
+                ("synchronous", self.synchronous, self.synchronous_modes),
+                ("temp_store", self.temp_store, self.temp_stores) ]:
+            if str(value).lower() not in choices:
+                raise ValueError("Invalid {} \"{}\", expected one of {}".format(name, value,
+                        ", ".join(choices)))
+
+        return [ "PRAGMA journal_mode = " + self.journal_mode.lower(),
+                "PRAGMA synchronous = " + self.synchronous.lower(),
+                "PRAGMA cache_size = " + str(-int(self.cache_size) * 1024),
+                "PRAGMA mmap_size = " + str(int(self.mmap_size) * 1024 * 1024),
+                "PRAGMA temp_store = " + self.temp_store.lower() ]
+
+
 class DatabaseVersionError(Exception):
     pass
 
@@ -124,18 +191,34 @@ class QueryError(Exception):
 
 
 class Database:
-    schema_version = 12
+    schema_version = 17
+
+    # Scripts that migrate the database from one schema version to the next one
+    migrations = { 9: (11, "migrate-9-11.sql"), 11: (12, "migrate-11-12.sql"),
+            12: (13, "migrate-12-13.sql"), 13: (14, "migrate-13-14.sql"),
+            14: (15, "migrate-14-15.sql"), 15: (16, "migrate-15-16.sql"),
+            16: (17, "migrate-16-17.sql") }
+
+    def __init__(self, file_name, profile=None):
+        profile = profile or ConnectionProfile()
 
-    def __init__(self, file_name):
         def connect(self):
             self.conn = sqlite3.connect(file_name, detect_types=sqlite3.PARSE_DECLTYPES)
+            for pragma in profile.pragmas():
+                self.conn.execute(pragma).fetchall()
 
         # Try using the existing db, if the version differs from the internal schema version,
         # delete the database and start over
         connect(self)
+        # Ids of known course root folders and of known subfolders by (parent id, name)
+        self.course_roots = {}
+        self.folder_ids = {}
+
         db_version, = self.query("PRAGMA user_version", expected_rows=1)[0]
+        self.created = db_version == 0
+        self.migrated = False
         if db_version < self.schema_version:
-            if db_version in [ 9, 11 ]:
+            if db_version in self.migrations:
                 # Disconnect and reconnect to create a backup
                 self.conn.close()
                 base_name, ext = os.path.splitext(file_name)
@@ -143,10 +226,11 @@ class Database:
                 shutil.copyfile(file_name, backup_file)
                 connect(self)
 
-                if db_version < 11:
-                    self.query_script_file("migrate-9-11.sql")
-                if db_version < 12:
-                    self.query_script_file("migrate-11-12.sql")
+                version = db_version
+                while version < self.schema_version:
+                    version, script = self.migrations[version]
+                    self.query_script_file(script)
+                self.migrated = True
 
                 print("Migrated database from version {} to {}, backup saved to {}".format(
                         db_version, self.schema_version, backup_file))
@@ -268,6 +352,7 @@ class Database:
 
 
     def delete_course(self, course):
+        self.course_roots.pop(course.id, None)
         self.query("""
                 DELETE FROM courses
                 WHERE id = :id;
@@ -289,8 +374,7 @@ class Database:
                     FROM file_details
                     WHERE sync IN ({});
                 """.format(", ".join(sync_modes)))
-            # Path is encoded as the string representation of a python list
-            return [ File(i, j, s, c, b, o, u, ast.literal_eval(path), n, e, a, d, t, y, l, v)
+            return [ File(i, j, s, c, b, o, u, decode_path(path), n, e, a, d, t, y, l, v)
                     for i, j, s, c, b, o, u, path, n, e, a, d, t, y, l, v in rows ]
 
         else:
@@ -303,65 +387,112 @@ class Database:
 
 
     def create_parent_for_file(self, file):
-        rows = self.query("""
-                SELECT root FROM courses
-                WHERE id = :course
-            """, course=file.course)
-        parent, = rows[0]
+        # Folders are never renamed, moved or deleted, so once known, ids stay valid
+        parent = self.course_roots.get(file.course)
+        if parent is None:
+            rows = self.query("""
+                    SELECT root FROM courses
+                    WHERE id = :course
+                """, course=file.course)
+            parent, = rows[0]
+            self.course_roots[file.course] = parent
 
         for folder in file.path:
-            def query_subdirectory():
-                return self.query("""
+            key = (parent, folder)
+            folder_id = self.folder_ids.get(key)
+            if folder_id is None:
+                rows = self.query("""
                         SELECT id FROM folders
                         WHERE parent = :par AND name = :name
                     """, par=parent, name=folder)
-
-            rows = query_subdirectory()
-            if not rows:
-                self.query("""
-                        INSERT INTO folders (name, parent)
-                        VALUES(:name, :par)
-                    """, name=folder, par=parent, expected_rows=0)
-                rows = query_subdirectory()
-            parent, = rows[0]
+                if rows:
+                    folder_id, = rows[0]
+                else:
+                    folder_id = self.conn.execute("""
+                            INSERT INTO folders (name, parent)
+                            VALUES(:name, :par)
+                        """, dict(name=folder, par=parent)).lastrowid
+                self.folder_ids[key] = folder_id
+            parent = folder_id
 
         return parent
 
 
-    def add_file(self, file):
-        parent = self.create_parent_for_file(file)
-        self.query("""
+    def file_parameters(self, file):
+        return dict(id=file.id, par=self.create_parent_for_file(file), name=file.name,
+                ext=file.extension, auth=file.author, descr=file.description,
+                creat=file.remote_date, copy=file.copyrighted, local=file.local_date)
+
+
+    def add_files(self, files):
+        rows = [ self.file_parameters(file) for file in files ]
+        self.query_multiple("""
                 INSERT INTO files (id, folder, name, extension, author, description, remote_date,
                     copyrighted, local_date, version)
                 VALUES (:id, :par, :name, :ext, :auth, :descr, :creat, :copy, :local, 0);
-            """, id=file.id, par=parent, name=file.name, ext=file.extension, auth=file.author,
-                descr=file.description, creat=file.remote_date, copy=file.copyrighted,
-                local=file.local_date, expected_rows=0)
+            """, rows)
 
 
-    def update_file(self, file):
-        parent = self.create_parent_for_file(file)
-        self.query("""
+    def update_files(self, files):
+        rows = [ self.file_parameters(file) for file in files ]
+        self.query_multiple("""
                 UPDATE files
                 SET folder = :par, name = :name, extension = :ext, author = :auth,
                     description = :descr, remote_date = :creat, copyrighted = :copy,
                     local_date = :local, version = version + 1
                 WHERE id = :id;
-            """, id=file.id, par=parent, name=file.name, ext=file.extension, auth=file.author,
-                descr=file.description, creat=file.remote_date, copy=file.copyrighted,
-                local=file.local_date, expected_rows=0)
-        self.query("""
+            """, rows)
+        self.query_multiple("""
                 DELETE FROM checkouts
                 WHERE file=:id
-            """, id=file.id, expected_rows=0)
+            """, [ dict(id=file.id) for file in files ])
 
 
-    def update_file_local_date(self, file):
-        self.query("""
+    def set_local_dates(self, files):
+        self.query_multiple("""
                 UPDATE files
                 SET local_date = :local
                 WHERE id = :id
-            """, id=file.id, local=file.local_date, expected_rows=0)
+            """, [ dict(id=file.id, local=file.local_date) for file in files ])
+
+
+    def list_folder_pages(self):
+        rows = self.query("""
+                SELECT course, digest, files
+                FROM folder_pages;
+            """)
+        return dict((c, FolderPage(c, d, decode_file_list(f))) for c, d, f in rows)
+
+
+    def set_folder_page(self, page):
+        self.query("""
+                INSERT OR REPLACE INTO folder_pages (course, digest, files)
+                VALUES (:course, :digest, :files);
+            """, course=page.course, digest=page.digest, files=encode_file_list(page.files),
+                expected_rows=0)
+
+
+    def list_course_states(self):
+        rows = self.query("""
+                SELECT course, files_state, crawled
+                FROM course_states;
+            """)
+        return dict((c, CourseState(c, f, t)) for c, f, t in rows)
+
+
+    def set_course_state(self, state):
+        self.query("""
+                INSERT OR REPLACE INTO course_states (course, files_state, crawled)
+                VALUES (:course, :state, :crawled);
+            """, course=state.course, state=state.files_state, crawled=state.crawled,
+                expected_rows=0)
+
+
+    def delete_course_state(self, course_id):
+        self.query("""
+                DELETE FROM course_states
+                WHERE course = :course;
+            """, course=course_id, expected_rows=0)
 
 
     def list_views(self, full=False):
@@ -411,11 +542,11 @@ class Database:
             """, view=view_id)
         return [ id for id, in rows ]
 
-    def add_checkout(self, view_id, file_id):
-        self.query("""
-                INSERT INTO checkouts (view, file)
+    def add_checkouts(self, view_id, file_ids):
+        self.query_multiple("""
+                INSERT OR IGNORE INTO checkouts (view, file)
                 VALUES (:view, :file)
-            """, view=view_id, file=file_id, expected_rows=0)
+            """, [ dict(view=view_id, file=file_id) for file_id in file_ids ])
 
     def reset_checkouts(self, view_id):
         self.query("""
@@ -426,3 +557,11 @@ class Database:
     def commit(self):
         self.conn.commit()
 
+    def optimize(self, vacuum=False):
+        self.conn.commit()
+        self.query_script("ANALYZE; PRAGMA optimize;")
+        if vacuum:
+            self.query_script("VACUUM;")
+        # Move everything from the write-ahead log into the database file and truncate the log
+        self.query("PRAGMA wal_checkpoint(TRUNCATE)")
+
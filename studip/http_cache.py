@@ -0,0 +1,118 @@
+import os, json, hashlib, shutil
+
+from os import path
+
+
+class CachedResponse:
+    def __init__(self, key, entry, response, previous_entry=None):
+        self.key = key
+        self.entry = entry
+        self.response = response
+        self.previous_entry = previous_entry
+        # Only known in advance for "304 Not Modified" responses, which have no body
+        self.unchanged = response is None
+
+    @property
+    def text(self):
+        return self.response.text if self.response is not None else None
+
+    def set_digest(self, digest):
+        self.entry["digest"] = digest
+        self.unchanged = self.previous_entry is not None \
+                and self.previous_entry["digest"] == digest
+
+    def set_data(self, data):
+        """Stores data derived from the page with the entry, so that it does not need to be
+        derived again while the page is unchanged. Must be serializable as JSON."""
+        self.entry["data"] = data
+
+    @property
+    def data(self):
+        if self.response is None:
+            return self.entry.get("data")
+        return self.previous_entry.get("data") if self.unchanged else None
+
+    def iter_content(self, chunk_size):
+        """Yields the body of a streamed response, whose digest is known once it is complete"""
+        digest = hashlib.sha256()
+        for chunk in self.response.iter_content(chunk_size):
+            digest.update(chunk)
+            yield chunk
+        self.set_digest(digest.hexdigest())
+
+
+class HttpCache:
+    """Remembers the validators and a content digest of previously fetched pages, so that
+    unchanged pages can be recognized without parsing them again.
+
+    Entries are only written by store(), which must be called once the page contents have been
+    processed and committed to the database. Otherwise a failed run could cause changes to be
+    skipped permanently."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def entry_file_name(self, key):
+        return path.join(self.cache_dir, key + ".json")
+
+    def load(self, key):
+        try:
+            with open(self.entry_file_name(key), "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def get_key(self, method, url, data=None):
+        return hashlib.sha1(repr((method, url, sorted(data.items()) if data else None))
+                .encode("utf-8")).hexdigest()
+
+    def request(self, http, method, url, stream=False, validate=True, **kwargs):
+        """Requests a page, sending the validators of a previous response if available and
+        validate is True. The body of a streamed response must be read through
+        CachedResponse.iter_content()."""
+        key = self.get_key(method, url, kwargs.get("data"))
+        entry = self.load(key)
+
+        # Conditional POST requests have different semantics, only the digest is used for them
+        headers = dict(kwargs.pop("headers", {}))
+        if entry and validate and method == "GET":
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        r = http.request(method, url, headers=headers, stream=stream, **kwargs)
+        if r.status_code == 304 and entry:
+            r.close()
+            return CachedResponse(key, entry, None)
+        try:
+            r.raise_for_status()
+        except:
+            r.close()
+            raise
+
+        new_entry = {
+            "url": url,
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "digest": None
+        }
+        response = CachedResponse(key, new_entry, r, entry)
+        if not stream:
+            response.set_digest(hashlib.sha256(r.content).hexdigest())
+        return response
+
+    def store(self, response):
+        # Incompletely received responses are not stored
+        if response.response is None or response.entry["digest"] is None:
+            return
+        file_name = self.entry_file_name(response.key)
+        temp_file_name = file_name + ".tmp"
+        with open(temp_file_name, "w", encoding="utf-8") as file:
+            json.dump(response.entry, file)
+        os.replace(temp_file_name, file_name)
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
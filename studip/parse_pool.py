@@ -0,0 +1,41 @@
+import multiprocessing
+
+
+def decode_page(content, encoding):
+    # Same as requests.Response.text
+    return str(content, encoding or "utf-8", errors="replace")
+
+
+def parse_content(function, content, encoding, *args):
+    return function(*args, decode_page(content, encoding))
+
+
+class ParserPool:
+    """Runs the parse_* functions on raw page contents, either directly in the calling thread or,
+    if processes > 0, in a pool of worker processes. Parsing is CPU-bound, so with several
+    threads fetching pages, a process pool lets parsing overlap despite the GIL. Only the parse
+    results are sent back to the calling process.
+
+    The processes are spawned rather than forked, because forking a process that runs several
+    threads can leave locks of the child in an inconsistent state."""
+
+    def __init__(self, processes=0):
+        self.pool = None
+        if processes > 0:
+            self.pool = multiprocessing.get_context("spawn").Pool(processes)
+
+    @property
+    def inline(self):
+        return self.pool is None
+
+    def parse(self, function, content, encoding, *args):
+        """Calls function(*args, html) with html decoded from content"""
+        if self.pool is None:
+            return parse_content(function, content, encoding, *args)
+        return self.pool.apply(parse_content, (function, content, encoding) + args)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
@@ -6,11 +6,39 @@ from datetime import datetime
 
 from .database import Semester, Course, SyncMode, File
 from .util import compact
+from html import unescape
 
 DUPLICATE_TYPE_RE = re.compile(r'^(?P<type>(Plenarü|Tutorü|Ü)bung(en)?|Tutorium|Praktikum'
         + r'|(Obers|Haupts|S)eminar|Lectures?|Exercises?)(\s+(f[oü]r|on|zu[rm]?|i[nm]|auf))?'
         + r'\s+(?P<name>.+)')
 COURSE_NAME_TYPE_RE = re.compile(r'(.*?)\s*\(\s*([^)]+)\s*\)\s*$')
+# Matches ".../icons/16/red/new/files.png" as well as ".../files+new.svg"
+NEW_ICON_RE = re.compile(r'[/+]new[/.]')
+
+# Used by the scanner backend, which only looks at the file_<id>_0 blocks of a folder page.
+# Like HTMLParser, names are matched case-insensitively and attribute values in any quoting,
+# which may contain ">". Quoted values are matched as a whole, one character at a time otherwise,
+# so that a tag that does not match fails without backtracking.
+ATTRS = r'''(?:[^>"']|"[^"]*"|'[^']*')*'''
+FILE_BLOCK_RE = re.compile(r'<[dD][iI][vV]\s' + ATTRS + r'?(?<![-\w:.])[iI][dD]\s*=\s*(?:'
+        r'"file_(?:[^"]*_)?0"|\'file_(?:[^\']*_)?0\'|file_(?:[^\s"\'>]*_)?0(?=[\s>]))'
+        + ATTRS + '>')
+# The start of a tag at the end of a partially received page
+INCOMPLETE_TAG_RE = re.compile(r'<' + ATTRS + r'''(?:"[^"]*|'[^']*)?\Z''')
+# HTMLParser does not look for tags in comments, scripts and style sheets
+SKIPPED_START_RE = re.compile(r'<!--|<(?:script|style)\b', re.I)
+SKIPPED_RE = re.compile(r'<!--.*?-->|<(script|style)\b.*?</\1\s*>', re.I | re.S)
+DIV_TAG_RE = re.compile(r'<(/?)div\b' + ATTRS + '>', re.I)
+ANCHOR_RE = re.compile(r'<a\s(' + ATTRS + r')>(.*?)</a\s*>', re.I | re.S)
+SPAN_RE = re.compile(r'<span\s(' + ATTRS + r')>(.*?)</span\s*>', re.I | re.S)
+TD_START_RE = re.compile(r'<td\b' + ATTRS + '>', re.I)
+TD_END_RE = re.compile(r'</td\s*>', re.I)
+OPEN_TAG_RE = re.compile(r'<(/?)(a|div)\b(' + ATTRS + ')>', re.I)
+ANCHOR_END_RE = re.compile(r'</a\b', re.I)
+TAG_RE = re.compile('<' + ATTRS + '>')
+ATTR_RE = re.compile(r'([a-zA-Z_:][-a-zA-Z0-9_:.]*)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))')
+
+PARSER_BACKENDS = [ "html", "scanner" ]
 
 
 def get_url_field(url, field):
@@ -153,6 +181,15 @@ def parse_semester_list(html):
     return parser
 
 
+class FileIndicator:
+    """The files icon shown for a course on the overview page. Its title contains the number of
+    files, and new is set if files have been added since the user last visited the folder."""
+
+    def __init__(self, new, state):
+        self.new = new
+        self.state = state
+
+
 class CourseListParser(HTMLParser):
     State = IntEnum("State", "before_sem before_thead_end table_caption before_tr "
         "tr td_group td_img td_id td_name after_td a_name")
@@ -165,6 +202,8 @@ class CourseListParser(HTMLParser):
         self.current_id = None
         self.current_number = None
         self.current_name = None
+        self.in_files_a = False
+        self.file_indicators = {}
 
     def handle_starttag(self, tag, attrs):
         State = CourseListParser.State
@@ -185,9 +224,20 @@ class CourseListParser(HTMLParser):
             attrs = dict(attrs)
             self.current_id = get_url_field(attrs["href"], "auswahl")
             self.state = State.a_name
+        elif self.state == State.after_td and tag == "a":
+            attrs = dict(attrs)
+            self.in_files_a = "folder.php" in attrs.get("href", "")
+        elif self.in_files_a and tag == "img":
+            attrs = dict(attrs)
+            src = attrs.get("src", "")
+            self.file_indicators[self.current_id] = FileIndicator(bool(NEW_ICON_RE.search(src)),
+                    attrs.get("title") or src)
 
     def handle_endtag(self, tag):
         State = CourseListParser.State
+        if tag == "a":
+            self.in_files_a = False
+
         if tag == "div" and self.state != State.before_sem:
             raise StopParsing
         elif self.state == State.before_thead_end:
@@ -225,6 +275,15 @@ class CourseListParser(HTMLParser):
 def parse_course_list(html):
     return create_parser_and_feed(CourseListParser, html).courses
 
+def parse_file_indicators(html):
+    """Returns the FileIndicator of each course on the overview page by course id. Courses
+    without a files icon are missing."""
+    return create_parser_and_feed(CourseListParser, html).file_indicators
+
+def parse_course_list_and_file_indicators(html):
+    parser = create_parser_and_feed(CourseListParser, html)
+    return parser.courses, parser.file_indicators
+
 
 class OverviewParser(HTMLParser):
     def __init__(self):
@@ -242,16 +301,31 @@ def parse_overview(html):
 
 
 class FileListParser(HTMLParser):
-    State = IntEnum("State", "outside file_0_div profile_a date_td")
+    State = IntEnum("State", "outside file_0_div header_span profile_a date_td folder_a")
 
     def __init__(self):
         super().__init__()
         State = FileListParser.State
         self.state = State.outside
         self.div_depth = 0
-        self.file_meta = []
-        self.current_file_id = None
+        self.files = []
+        self.current_file = None
         self.current_date = ""
+        self.after_date = False
+        self.pending = ""
+
+    def feed(self, data):
+        # HTMLParser would split text at the end of a chunk into several handle_data calls, so
+        # text is only passed on once the following tag has started
+        data = self.pending + data
+        end = data.rfind("<") + 1
+        self.pending = data[end:]
+        super().feed(data[:end])
+
+    def close(self):
+        super().feed(self.pending)
+        self.pending = ""
+        super().close()
 
     def handle_starttag(self, tag, attrs):
         State = FileListParser.State
@@ -260,49 +334,97 @@ class FileListParser(HTMLParser):
             if "id" in attrs and attrs["id"].startswith("file_") and attrs["id"].endswith("_0"):
                 self.state = State.file_0_div
                 self.div_depth = 0
-        elif self.state == State.file_0_div:
+                self.current_file = File(None)
+                self.current_date = ""
+                self.after_date = False
+        elif self.state in [ State.file_0_div, State.header_span ]:
             attrs = dict(attrs)
             if tag == "div":
                 self.div_depth += 1
+                # Folder and copyright notice are only present if the file entry is expanded,
+                # in which case they follow the date just like on the file details page
+                if self.after_date and "class" in attrs and "messagebox" in attrs["class"]:
+                    self.current_file.copyrighted = True
+            elif tag == "span" and self.state == State.file_0_div and "id" in attrs \
+                    and attrs["id"].endswith("_header") and "style" in attrs \
+                    and "bold" in attrs["style"]:
+                self.state = State.header_span
             if tag == "a" and "href" in attrs:
-                if "sendfile.php" in attrs["href"]:
-                    file_id = get_url_field(attrs["href"], "file_id")
+                href = attrs["href"]
+                if "sendfile.php" in href:
+                    file_id = get_url_field(href, "file_id")
                     if file_id:
-                        self.current_file_id = file_id
-                elif "dispatch.php/profile" in attrs["href"]:
-                    self.state = State.profile_a
+                        self.current_file.id = file_id
+                    file_name = get_url_field(href, "file_name")
+                    if file_name and not "zip=" in href:
+                        file_name_parts = file_name.rsplit(".", 1)
+                        self.current_file.name = file_name_parts[0]
+                        self.current_file.extension = file_name_parts[1] \
+                                if len(file_name_parts) > 1 else ""
+                elif self.state == State.file_0_div:
+                    if "dispatch.php/profile" in href:
+                        self.state = State.profile_a
+                    elif self.after_date and "folder.php" in href:
+                        self.state = State.folder_a
 
     def handle_endtag(self, tag):
         State = FileListParser.State
-        if tag == "div" and self.state == State.file_0_div:
+        if tag == "div" and self.state in [ State.file_0_div, State.header_span ]:
             if self.div_depth > 0:
                 self.div_depth -= 1
             else:
-                file_id = self.current_file_id
+                file = self.current_file
                 date_str = compact(self.current_date)
-                date = None
-                if file_id and self.current_date:
+                if file.id and self.current_date:
                     try:
-                        date = datetime.strptime(date_str, "%d.%m.%Y - %H:%M")
+                        file.remote_date = datetime.strptime(date_str, "%d.%m.%Y - %H:%M")
                     except:
                         pass
-                if file_id and date:
-                    self.file_meta.append((file_id, date))
-                self.current_file_id = None
+                if file.id and file.remote_date:
+                    self.files.append(file)
+                self.current_file = None
                 self.current_date = ""
                 self.state = State.outside
+        elif tag == "span" and self.state == State.header_span:
+            self.state = State.file_0_div
         elif tag == "a" and self.state == State.profile_a:
             self.state = State.date_td
         elif tag == "td" and self.state == State.date_td:
             self.state = State.file_0_div
+            self.after_date = True
+        elif tag == "a" and self.state == State.folder_a:
+            self.state = State.file_0_div
 
     def handle_data(self, data):
         State = FileListParser.State
         if self.state == State.date_td:
             self.current_date += data
+        elif self.state == State.header_span:
+            self.current_file.description = data
+        elif self.state == State.profile_a:
+            self.current_file.author = data
+        elif self.state == State.folder_a:
+            self.current_file.path = data.split(sep=" / ")
+
+    @property
+    def file_meta(self):
+        return [ (file.id, file.remote_date) for file in self.files ]
+
+def create_file_list_parser_and_feed(backend, html):
+    parser = create_parser_and_feed(get_file_list_parser(backend), html)
+    parser.close()
+    return parser
+
+def parse_file_list(html, backend="html"):
+    return create_file_list_parser_and_feed(backend, html).file_meta
 
-def parse_file_list(html):
-    return create_parser_and_feed(FileListParser, html).file_meta
+def parse_file_list_details(course_id, html, backend="html"):
+    """Returns all files from a folder page as File objects. Only the files expanded on the page
+    carry a path and are complete(), the others need to be completed via parse_file_details."""
+    files = create_file_list_parser_and_feed(backend, html).files
+    for file in files:
+        file.course = course_id
+    return files
 
 
 class FileDetailsParser(HTMLParser):
@@ -385,10 +507,251 @@ class FileDetailsParser(HTMLParser):
         elif self.state == State.in_author_a:
             self.file.author = data
 
-def parse_file_details(course_id, html):
-    file = create_parser_and_feed(FileDetailsParser, html).file
+def parse_file_details(course_id, html, backend="html"):
+    file = create_parser_and_feed(get_file_details_parser(backend), html).file
     file.course = course_id
     if file.complete():
         return file
     else:
         raise ParserError("FileDetails")
+
+
+def get_query_field(url, field):
+    """Same as get_url_field(), but faster for the plain name=value pairs used by Stud.IP"""
+    query = url.partition("#")[0].partition("?")[2]
+    if ";" in query:
+        return get_url_field(url, field)
+    for pair in query.split("&"):
+        name, sep, value = pair.partition("=")
+        if "%" in name or "+" in name:
+            name = urlparse.unquote_plus(name, encoding="iso-8859-1")
+        # Like parse_qs, skip blank values
+        if name == field and value:
+            return urlparse.unquote_plus(value, encoding="iso-8859-1")
+    return None
+
+def get_attrs(attr_str):
+    return dict((name.lower(), unescape(double or single or unquoted))
+            for name, double, single, unquoted in ATTR_RE.findall(attr_str))
+
+def get_text_segments(html):
+    # The chunks of text that HTMLParser would report through handle_data()
+    return [ unescape(text) for text in TAG_RE.split(html) if text ]
+
+def get_last_text(html, default=None):
+    segments = get_text_segments(html)
+    return segments[-1] if segments else default
+
+def get_text(html):
+    return "".join(get_text_segments(html))
+
+def find_file_block(html, pos=0):
+    """Returns the next file_<id>_0 block outside of comments and scripts, or None and the
+    position from which the block might follow once more of the page has been received"""
+    while True:
+        match = FILE_BLOCK_RE.search(html, pos)
+        skipped = SKIPPED_START_RE.search(html, pos, match.start() if match else len(html))
+        if skipped:
+            skipped_end = SKIPPED_RE.match(html, skipped.start())
+            if not skipped_end:
+                return None, skipped.start()
+            pos = skipped_end.end()
+        elif match:
+            return match, match.start()
+        else:
+            incomplete = INCOMPLETE_TAG_RE.search(html, pos)
+            return None, incomplete.start() if incomplete else len(html)
+
+def find_block_end(html, pos):
+    depth = 0
+    for match in DIV_TAG_RE.finditer(html, pos):
+        if not match.group(1):
+            depth += 1
+        elif depth > 0:
+            depth -= 1
+        else:
+            return match.end()
+    return None
+
+def find_header_span(html, pos=0, endpos=None):
+    endpos = len(html) if endpos is None else endpos
+    for match in SPAN_RE.finditer(html, pos, endpos):
+        attrs = get_attrs(match.group(1))
+        if attrs.get("id", "").endswith("_header") and "bold" in attrs.get("style", ""):
+            return match
+    return None
+
+def set_file_name(file, href):
+    file_name = get_query_field(href, "file_name")
+    file_name_parts = file_name.rsplit(".", 1)
+    file.name = file_name_parts[0]
+    file.extension = file_name_parts[1] if len(file_name_parts) > 1 else ""
+
+
+class FileListScanner:
+    """Extracts the same files as FileListParser, but jumps directly to the file_<id>_0 blocks
+    of the page and picks out the few elements of interest with regular expressions instead of
+    tokenizing the whole page. Like FileListParser, it can be fed the page in chunks."""
+
+    def __init__(self):
+        self.files = []
+        self.buffer = ""
+
+    def feed(self, html):
+        # Blocks are scanned once they have been received completely. Blocks nested in other
+        # blocks are skipped, as FileListParser does not recognize them either.
+        html = self.buffer + html
+        pos = 0
+        while True:
+            match, pos = find_file_block(html, pos)
+            if not match:
+                # The start of the next block might not have been received completely
+                break
+            block_end = find_block_end(html, match.end())
+            if block_end is None:
+                break
+            file = self.scan_block(html, match.end(), block_end)
+            if file.id and file.remote_date:
+                self.files.append(file)
+            pos = block_end
+        self.buffer = html[pos:]
+
+    def close(self):
+        # An unterminated block at the end of the page is not recognized by FileListParser either
+        self.buffer = ""
+
+    def scan_block(self, html, start, end):
+        file = File(None)
+
+        header = find_header_span(html, start, end)
+        if header:
+            file.description = get_last_text(header.group(2), file.description)
+
+        date_start = date_end = None
+        for match in ANCHOR_RE.finditer(html, start, end):
+            if date_start is not None and date_start <= match.start() < date_end:
+                continue
+            href = get_attrs(match.group(1)).get("href")
+            if href is None:
+                continue
+            in_header = header is not None and header.start() <= match.start() < header.end()
+            if "sendfile.php" in href:
+                file_id = get_query_field(href, "file_id")
+                if file_id:
+                    file.id = file_id
+                if get_query_field(href, "file_name") and not "zip=" in href:
+                    set_file_name(file, href)
+            elif in_header:
+                pass
+            elif "dispatch.php/profile" in href:
+                file.author = get_last_text(match.group(2), file.author)
+                date_start = match.end()
+                td_end = TD_END_RE.search(html, date_start, end)
+                date_end = td_end.start() if td_end else end
+                date_str = compact(get_text(html[date_start:date_end]))
+                try:
+                    file.remote_date = datetime.strptime(date_str, "%d.%m.%Y - %H:%M")
+                except ValueError:
+                    pass
+            elif date_end is not None and match.start() >= date_end and "folder.php" in href:
+                path = get_last_text(match.group(2))
+                if path is not None:
+                    file.path = path.split(sep=" / ")
+
+        if date_end is not None:
+            for match in DIV_TAG_RE.finditer(html, date_end, end):
+                if not match.group(1) and "messagebox" in get_attrs(match.group(0)[4:]) \
+                        .get("class", ""):
+                    file.copyrighted = True
+
+        return file
+
+    @property
+    def file_meta(self):
+        return [ (file.id, file.remote_date) for file in self.files ]
+
+
+class FileDetailsScanner:
+    """Extracts the same file as FileDetailsParser from a page showing the details of a file"""
+
+    def __init__(self):
+        self.file = File(None)
+
+    def feed(self, html):
+        file = self.file
+        block, pos = find_file_block(html)
+        if not block:
+            return
+        header = find_header_span(html, block.end())
+        if not header:
+            return
+        file.description = get_last_text(header.group(2), file.description)
+
+        # The first cell after the header contains the author and the date
+        td_start = TD_START_RE.search(html, header.end())
+        if not td_start:
+            return
+        td_end = TD_END_RE.search(html, td_start.end())
+        origin_end = td_end.start() if td_end else len(html)
+        date = ""
+        pos = td_start.end()
+        for match in ANCHOR_RE.finditer(html, td_start.end(), origin_end):
+            date += get_text(html[pos:match.start()])
+            file.author = get_last_text(match.group(2), file.author)
+            pos = match.end()
+        date += get_text(html[pos:origin_end])
+        if not td_end:
+            return
+        try:
+            file.remote_date = datetime.strptime(compact(date), "%d.%m.%Y - %H:%M")
+        except ValueError:
+            pass
+
+        # The remaining details follow until the end of the file's block
+        depth = find_div_depth(html, block.end(), header.start())
+        pos = td_end.end()
+        while True:
+            match = OPEN_TAG_RE.search(html, pos)
+            if not match:
+                return
+            pos = match.end()
+            closing, tag = match.group(1), match.group(2).lower()
+            if tag == "div":
+                if closing:
+                    if depth > 0:
+                        depth -= 1
+                    elif file.id is not None:
+                        return
+                elif "messagebox" in get_attrs(match.group(3)).get("class", ""):
+                    file.copyrighted = True
+            elif not closing:
+                href = get_attrs(match.group(3)).get("href")
+                if href is None:
+                    continue
+                if "folder.php" in href:
+                    anchor_end = ANCHOR_END_RE.search(html, pos)
+                    anchor_end = anchor_end.start() if anchor_end else len(html)
+                    path = get_last_text(html[pos:anchor_end])
+                    if path is not None:
+                        file.path = path.split(sep=" / ")
+                    pos = anchor_end
+                elif "sendfile.php" in href and not "zip=" in href:
+                    file.id = get_query_field(href, "file_id")
+                    set_file_name(file, href)
+
+
+def find_div_depth(html, start, end):
+    depth = 0
+    for match in DIV_TAG_RE.finditer(html, start, end):
+        if not match.group(1):
+            depth += 1
+        elif depth > 0:
+            depth -= 1
+    return depth
+
+
+def get_file_list_parser(backend):
+    return { "html": FileListParser, "scanner": FileListScanner }[backend]
+
+def get_file_details_parser(backend):
+    return { "html": FileDetailsParser, "scanner": FileDetailsScanner }[backend]
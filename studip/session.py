@@ -1,17 +1,30 @@
-import os, time, threading, ctypes
+import os, re, json, time, codecs, shutil, tempfile, zipfile, unicodedata, threading
 
-from requests import session, RequestException, Timeout
-from urllib.parse import urlencode
+from requests import session, RequestException, HTTPError, Timeout, ReadTimeout
+from urllib.parse import urlencode, urlsplit
 from os import path
 from threading import Thread, Condition, Lock
 from copy import deepcopy
+from functools import partial
+from contextlib import contextmanager
+from collections import OrderedDict, deque
 from enum import IntEnum
+from datetime import datetime, timedelta
 
 from .parsers import *
-from .database import SyncMode
+from .database import SyncMode, FolderPage, CourseState
 from .util import prompt_choice, ellipsize, escape_file_name, \
         abbreviate_course_name, abbreviate_course_type
-from .async import ThreadPool
+from .async import ThreadPool, TaskFailure, TaskAborted
+from .http_cache import HttpCache
+from .parse_pool import ParserPool
+from .throttle import Throttle, AdaptiveLimiter, ThrottledSession, backoff_delay, \
+        is_server_error, get_retry_after
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+FOLDER_CHUNK_SIZE = 16 * 1024
+DOWNLOAD_CHECKPOINT_SIZE = 16 * 1024 * 1024
+CONTENT_RANGE_RE = re.compile(r"^\s*bytes\s+(\d+)-")
 
 
 class SessionError(Exception):
@@ -25,23 +38,577 @@ def raise_fetch_error(page, e):
     raise SessionError("Unable to fetch {}: {}".format(page, str(e)))
 
 
+def get_member_name(member):
+    # Without the UTF-8 flag, ZipFile decodes names as CP437, but Stud.IP writes UTF-8 anyway
+    name = member.filename
+    if not member.flag_bits & 0x800:
+        try:
+            name = name.encode("cp437").decode("utf-8")
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            pass
+    return name.rsplit("/", 1)[-1]
+
+
+def normalize_member_name(name):
+    return unicodedata.normalize("NFC", name).casefold()
+
+
 class SessionPool(ThreadPool):
-    def __init__(self, n_threads, cookies):
-        super().__init__(n_threads, { "cookies": cookies })
+    def __init__(self, n_threads, cookies, throttle, max_queued=0):
+        # Shared between all threads, so it cannot be part of the (copied) local state
+        self.throttle = throttle
+        super().__init__(n_threads, { "cookies": cookies }, max_queued)
 
     def init_thread(self, local_state):
-        session = requests.session()
+        session = ThrottledSession(self.throttle)
         session.cookies = local_state["cookies"]
         local_state["session"] = session
 
     def cleanup_thread(self, local_state):
-        local_state["session"].close()
+        if "session" in local_state:
+            local_state["session"].close()
 
     def execute_task(self, local_state, task):
         return local_state["session"].request(task["method"], *task["args"], **task["kwargs"])
 
     def defer_request(self, method, *args, **kwargs):
-        self.defer({ "method": method, "args": args, "kwargs": kwargs })
+        return self.defer({ "method": method, "args": args, "kwargs": kwargs })
+
+
+class CourseScan:
+    def __init__(self, course, folder, page, new_files, updated_files, files, failures):
+        self.course = course
+        self.folder = folder
+        self.page = page
+        self.new_files = new_files
+        self.updated_files = updated_files
+        self.files = files
+        self.failures = failures
+
+
+class WorkerPool(SessionPool):
+    """The pool that carries out the requests of all sync phases, so that connections and logins
+    are reused for the whole run. Tasks are dicts whose "run" entry is called with the worker's
+    local state and the task itself. Tasks that need a course context obtain the worker's own
+    Stud.IP session through course_session(), everything else uses the main session."""
+
+    def __init__(self, session, n_threads, detail_concurrency):
+        # Set before the worker threads are started by the base class
+        self.session = session
+        self.detail_concurrency = detail_concurrency
+        self.login_failed = False
+        self.shared_lock = Lock()
+        self.shared_detail_pool = None
+        super().__init__(n_threads, session.http.cookies, session.throttle)
+
+    def init_thread(self, local_state):
+        super().init_thread(local_state)
+        http = local_state["session"]
+
+        # Stud.IP keeps the current course on the server side, so every worker needs its own
+        # Stud.IP session. Only the SSO cookies are kept, so that authenticating is cheap.
+        sso_host = urlsplit(self.session.config["server", "sso_base"]).hostname
+        for cookie in list(http.cookies):
+            if not sso_host.endswith(cookie.domain.lstrip(".")):
+                http.cookies.clear(cookie.domain, cookie.path, cookie.name)
+
+    @contextmanager
+    def course_session(self, local_state):
+        """Provides a Stud.IP session and the pool for requesting file details through it to a
+        task that needs a course context. The worker logs in before its first such task."""
+        http = local_state["session"]
+        if "detail_pool" not in local_state and not self.login_failed:
+            try:
+                # Workers never ask for the password, the main thread may be prompting as well
+                self.session.authenticate(http, interactive=False)
+                local_state["detail_pool"] = SessionPool(self.detail_concurrency, http.cookies,
+                        self.throttle)
+            except LoginError as e:
+                if not self.login_failed:
+                    self.login_failed = True
+                    print("Unable to log in additional sessions ({}), scanning courses one at "
+                            "a time".format(e))
+
+        if "detail_pool" in local_state:
+            yield http, local_state["detail_pool"]
+        else:
+            # Without a session of their own, workers take turns using the valid main session
+            with self.shared_lock:
+                if self.shared_detail_pool is None:
+                    self.shared_detail_pool = SessionPool(self.detail_concurrency,
+                            self.session.http.cookies, self.throttle)
+                yield self.session.http, self.shared_detail_pool
+
+    def close(self, drain=True):
+        try:
+            super().close(drain)
+        finally:
+            if self.shared_detail_pool is not None:
+                self.shared_detail_pool.close(drain)
+
+    def cleanup_thread(self, local_state):
+        if "detail_pool" in local_state:
+            local_state["detail_pool"].close(drain=not local_state["aborting"].is_set())
+        super().cleanup_thread(local_state)
+
+    def execute_task(self, local_state, task):
+        return task["run"](local_state, task)
+
+    def defer_call(self, function, **task):
+        task["run"] = function
+        return self.defer(task)
+
+
+class TaskLimit:
+    """Defers tasks to a pool with at most limit of them in flight at a time, so that the
+    concurrency of one kind of task is limited independently of the size of the pool. The other
+    tasks wait until completed() is called for a finished one. Only used from the main thread."""
+
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self.waiting = deque()
+        self.running = 0
+
+    def defer_call(self, pool, function, **task):
+        self.waiting.append((function, task))
+        self.start(pool)
+
+    def completed(self, pool):
+        self.running -= 1
+        self.start(pool)
+
+    def discard(self, predicate):
+        """Drops the tasks that have not been started yet and for which predicate(task) is True"""
+        self.waiting = deque((function, task) for function, task in self.waiting
+                if not predicate(task))
+
+    def start(self, pool):
+        while self.waiting and self.running < self.limit:
+            function, task = self.waiting.popleft()
+            pool.defer_call(function, **task)
+            self.running += 1
+
+
+class PartialDownload:
+    """A download in progress. Received data is kept in <file>.part, accompanied by a
+    <file>.part.info record of the number of bytes received and the remote date, so that an
+    interrupted download can be resumed by a later run."""
+
+    def __init__(self, file_path, remote_date):
+        self.part_path = file_path + ".part"
+        self.info_path = self.part_path + ".info"
+        self.remote_date = str(remote_date)
+        self.size = 0
+        self.validator = None
+
+        try:
+            with open(self.info_path, "r", encoding="utf-8") as file:
+                info = json.load(file)
+            # A partial download of an older revision of the file is useless
+            if info["remote_date"] == self.remote_date:
+                self.size = min(int(info["size"]), path.getsize(self.part_path))
+                self.validator = info["validator"]
+        except (OSError, ValueError, KeyError, TypeError):
+            self.size = 0
+            self.validator = None
+
+    def request_headers(self):
+        if self.size == 0:
+            return {}
+        headers = { "Range": "bytes={}-".format(self.size) }
+        if self.validator:
+            headers["If-Range"] = self.validator
+        return headers
+
+    def open(self, response):
+        """Opens the partial file for writing. Continues after the bytes already received if the
+        server has honoured the range request, otherwise starts over from the beginning."""
+        if self.size > 0 and response.status_code == 206:
+            writer = open(self.part_path, "r+b")
+            writer.truncate(self.size)
+            writer.seek(self.size)
+        else:
+            self.size = 0
+            writer = open(self.part_path, "wb")
+            # Weak ETags must not be used in If-Range
+            etag = response.headers.get("ETag")
+            self.validator = etag if etag and not etag.startswith("W/") \
+                    else response.headers.get("Last-Modified")
+        self.save()
+        return writer
+
+    def checkpoint(self, writer, size):
+        writer.flush()
+        os.fsync(writer.fileno())
+        self.size = size
+        self.save()
+
+    def save(self):
+        with open(self.info_path, "w", encoding="utf-8") as file:
+            json.dump({ "remote_date": self.remote_date, "size": self.size,
+                    "validator": self.validator }, file)
+
+    def discard(self):
+        for p in [ self.part_path, self.info_path ]:
+            try:
+                os.unlink(p)
+            except OSError:
+                pass
+        self.size = 0
+        self.validator = None
+
+    def finish(self, file_path):
+        os.replace(self.part_path, file_path)
+        os.unlink(self.info_path)
+
+
+def get_content_range_start(response):
+    match = CONTENT_RANGE_RE.match(response.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
+
+
+def request_download(http, url, partial):
+    # Retries are handled per download, so that they can resume where the last attempt ended
+    r = http.get(url, stream=True, headers=partial.request_headers(), retry=False)
+    if partial.size > 0 and (r.status_code == 416 or r.status_code == 206
+            and get_content_range_start(r) != partial.size):
+        # The partial file does not match the remote file anymore
+        r.close()
+        partial.discard()
+        r = http.get(url, stream=True, retry=False)
+    try:
+        r.raise_for_status()
+    except RequestException:
+        r.close()
+        raise
+    return r
+
+
+def download_file(http, url, partial, aborting):
+    r = request_download(http, url, partial)
+    try:
+        with partial.open(r) as writer:
+            received = partial.size
+            try:
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    # An aborted download can be resumed from the last checkpoint
+                    if aborting.is_set():
+                        raise TaskAborted()
+                    http.throttle.transfer(len(chunk))
+                    writer.write(chunk)
+                    received += len(chunk)
+                    if received - partial.size >= DOWNLOAD_CHECKPOINT_SIZE:
+                        partial.checkpoint(writer, received)
+            finally:
+                # Also record the bytes received when the transfer breaks off
+                partial.checkpoint(writer, received)
+    finally:
+        r.close()
+
+
+class MetadataUpdate:
+    """The update stage of a run. Fetches the overview page when created, then scans the
+    courses that may have changed on the worker pool and stores their files as the scans
+    complete. If set, on_files_stored is called with the files stored for a synchronized
+    course, with their version and course details filled in."""
+
+    def __init__(self, session, on_files_stored=None):
+        self.session = session
+        self.db = session.db
+        self.on_files_stored = on_files_stored
+
+        url = session.studip_url("/studip/dispatch.php/my_courses/set_semester")
+        try:
+            overview = session.http_cache.request(session.http, "POST", url,
+                    data={ "sem_select": "current" })
+        except RequestException as e:
+            raise_fetch_error("overview page", e)
+
+        # An unchanged overview page means that the course list has already been processed, and
+        # its file indicators are kept with the cache entry
+        file_indicators = overview.data if overview.unchanged else None
+        if file_indicators is not None:
+            self.file_indicators = dict((id, FileIndicator(new, state))
+                    for id, (new, state) in file_indicators.items())
+        elif not overview.unchanged:
+            self.file_indicators = session.update_course_list(overview.text)
+            self.db.commit()
+            overview.set_data(dict((id, [ indicator.new, indicator.state ])
+                    for id, indicator in self.file_indicators.items()))
+            session.http_cache.store(overview)
+        else:
+            try:
+                self.file_indicators = parse_file_indicators(overview.text)
+            except ParserError:
+                raise SessionError("Unable to parse course list")
+        course_states = self.db.list_course_states()
+        self.now = datetime.now()
+
+        self.sync_courses = []
+        self.skipped_courses = []
+        for course in self.db.list_courses(full=True, select_sync_no=False):
+            if session.needs_scan(self.file_indicators.get(course.id),
+                    course_states.get(course.id), self.now):
+                self.sync_courses.append(course)
+            else:
+                self.skipped_courses.append(course)
+
+        db_files = self.db.list_files(full=True, select_sync_yes=True,
+                select_sync_metadata_only=True, select_sync_no=False)
+        self.db_file_dict = dict((f.id, f) for f in db_files)
+        self.folder_pages = self.db.list_folder_pages()
+        self.failed_courses = []
+        self.last_course_synced = False
+        self.scan_limit = TaskLimit(int(session.config["connection", "scan_concurrency"]))
+
+    def defer_scans(self, pool):
+        for course in self.sync_courses:
+            self.scan_limit.defer_call(pool, self.session.run_course_scan, course=course,
+                    db_file_dict=self.db_file_dict, folder_page=self.folder_pages.get(course.id))
+
+    def handlers(self):
+        return { self.session.run_course_scan: self.scan_completed }
+
+    def scan_completed(self, task, scan):
+        self.scan_limit.completed(self.session.get_workers())
+
+        # Courses are reported and stored in the order their scans complete
+        if isinstance(scan, TaskFailure):
+            course = task["course"]
+            print("Unable to scan {} {}: {}".format(course.type, course.name, scan.exception))
+            self.failed_courses.append(course)
+            self.db.delete_course_state(course.id)
+            self.db.commit()
+            self.last_course_synced = False
+            return
+
+        course = scan.course
+        if self.last_course_synced:
+            print()
+
+        if len(scan.new_files) > 0:
+            new_files_str = ("" if self.last_course_synced else "\n") + str(len(scan.new_files))
+            self.last_course_synced = True
+        else:
+            new_files_str = "No"
+            self.last_course_synced = False
+
+        updated_files_str = ""
+        if len(scan.updated_files) > 0:
+            updated_files_str = ", {} updated ".format(len(scan.updated_files))
+
+        print("{} new{} file(s) for {} {} ".format(new_files_str, updated_files_str,
+                course.type, course.name))
+
+        stored_files = []
+        for i, file in enumerate(scan.files):
+            print("Fetched metadata for file {}/{}: ".format(i+1, len(scan.files)),
+                    end="", flush=True)
+            if file.complete():
+                stored_files.append(file)
+                print(" " + file.description)
+            else:
+                print(" <bad format>")
+        self.db.add_files([ f for f in stored_files if f.id in scan.new_files ])
+        self.db.update_files([ f for f in stored_files if f.id not in scan.new_files ])
+
+        for failure in scan.failures:
+            print(failure)
+
+        # Pages with missing details must be processed again during the next update
+        if scan.failures:
+            self.failed_courses.append(course)
+            self.db.delete_course_state(course.id)
+        else:
+            if scan.page:
+                self.db.set_folder_page(scan.page)
+            indicator = self.file_indicators.get(course.id)
+            self.db.set_course_state(CourseState(course.id,
+                    indicator.state if indicator else None, self.now))
+        self.db.commit()
+        if not scan.failures:
+            self.session.http_cache.store(scan.folder)
+
+        if self.on_files_stored and course.sync == SyncMode.Full and stored_files:
+            for file in stored_files:
+                # Same as the row written by add_files() or update_files()
+                previous = self.db_file_dict.get(file.id)
+                file.version = previous.version + 1 if previous else 0
+                file.course_semester = course.semester
+                file.course_name = course.name
+                file.course_type = course.type
+                file._course_abbrev = course._abbrev
+                file._course_type_abbrev = course._type_abbrev
+            self.on_files_stored(stored_files)
+
+    def report(self):
+        if self.skipped_courses:
+            print("\nSkipped {} course(s) without new files".format(len(self.skipped_courses)))
+
+        if self.failed_courses:
+            print("\nThe following courses could not be updated completely and will be retried"
+                    " during the next update:")
+            for course in self.failed_courses:
+                print("  {} {}".format(course.type, course.name))
+
+
+class FileFetch:
+    """The fetch stage of a run. Files added through add_files() are downloaded on the worker
+    pool, folders with many files as a single archive if enabled. If set, on_fetched is called
+    with each file once it has been fetched, before its new local date is committed. The local
+    dates of fetched files are committed in batches of commit_interval files by commit(), which
+    calls on_commit first if set."""
+
+    def __init__(self, session, on_fetched=None, on_commit=None):
+        self.session = session
+        self.db = session.db
+        self.on_fetched = on_fetched
+        self.on_commit = on_commit
+        self.files_dir = path.join(session.sync_dir, ".studip", "files")
+        os.makedirs(self.files_dir, exist_ok=True)
+        self.bulk_threshold = int(session.config["connection", "bulk_download_threshold"])
+        self.commit_interval = max(1, int(session.config["database", "commit_interval"]))
+        # Archives count as downloads
+        self.fetch_limit = TaskLimit(int(session.config["connection", "fetch_concurrency"]))
+        self.fetched_files = []
+        # The latest version queued of each file, older versions are not fetched anymore
+        self.queued_files = {}
+        self.n_pending = 0
+        self.n_processed = 0
+        self.first_file = True
+        self.failed_files = []
+
+    def get_file_paths(self, files):
+        return [ (f, path.join(self.files_dir, f.id)
+                + ("."  + str(f.version) if f.version > 0 else "")) for f in files ]
+
+    def list_pending_files(self):
+        sync_files = self.db.list_files(full=True, select_sync_metadata_only=False,
+                select_sync_no=False)
+        sync_file_updates = ((f, p, path.isfile(p), not f.local_date
+                or f.local_date != f.remote_date) for (f, p) in self.get_file_paths(sync_files))
+        return [ (f, p) for (f, p, exists, update) in sync_file_updates if not exists or update ]
+
+    def add_files(self, pool, files):
+        # A newer version of a queued file replaces it, so that it is not fetched anymore once it
+        # completes or, if it has not been started yet, at all. Older versions are ignored.
+        pending_files = []
+        superseded_ids = set()
+        for file, file_path in files:
+            queued = self.queued_files.get(file.id)
+            if queued is not None and queued.version > file.version:
+                continue
+            if queued is None:
+                self.n_pending += 1
+            else:
+                superseded_ids.add(file.id)
+            self.queued_files[file.id] = file
+            pending_files.append((file, file_path))
+        if superseded_ids:
+            self.fetch_limit.discard(lambda task: "file" in task
+                    and task["file"].id in superseded_ids)
+
+        # Folders with many pending files are fetched as a single archive, anything that is
+        # not contained in an archive is fetched separately afterwards
+        if self.bulk_threshold > 0:
+            folders = OrderedDict()
+            for file, file_path in pending_files:
+                folders.setdefault((file.course, tuple(file.path)), []).append((file, file_path))
+
+            pending_files = []
+            for (course, folder_path), files in folders.items():
+                if len(files) >= self.bulk_threshold:
+                    self.fetch_limit.defer_call(pool, self.session.run_archive_fetch,
+                            course=course, files=files, files_dir=self.files_dir)
+                else:
+                    pending_files += files
+
+        for file, file_path in pending_files:
+            self.defer_file(pool, file, file_path)
+
+    def is_queued(self, file):
+        return self.queued_files.get(file.id) is file
+
+    def defer_file(self, pool, file, file_path):
+        url = self.session.studip_url("/studip/sendfile.php?force_download=1&type=0&" \
+                + urlencode({"file_id": file.id, "file_name": file.name }))
+        self.fetch_limit.defer_call(pool, self.session.run_file_fetch, file=file, path=file_path,
+                url=url)
+
+    def handlers(self):
+        return { self.session.run_archive_fetch: self.archive_completed,
+                self.session.run_file_fetch: self.file_completed }
+
+    def print_first_file(self):
+        if self.first_file:
+            print()
+            self.first_file = False
+
+    def archive_completed(self, task, extracted):
+        self.print_first_file()
+        pool = self.session.get_workers()
+        self.fetch_limit.completed(pool)
+        if isinstance(extracted, TaskFailure):
+            folder_path = task["files"][0][0].path
+            print("Unable to fetch archive of {}, fetching its files separately: {}"
+                    .format("/".join(folder_path), extracted.exception))
+            extracted = []
+
+        extracted_ids = set()
+        for file, file_path in extracted:
+            if self.is_queued(file):
+                self.file_fetched(file, file_path)
+            extracted_ids.add(file.id)
+        self.commit(force=False)
+
+        for file, file_path in task["files"]:
+            if file.id not in extracted_ids and self.is_queued(file):
+                self.defer_file(pool, file, file_path)
+
+    def file_completed(self, task, result):
+        # Downloads finish in arbitrary order, so all bookkeeping is done per completed task
+        self.print_first_file()
+        self.fetch_limit.completed(self.session.get_workers())
+        if not self.is_queued(task["file"]):
+            return
+        if isinstance(result, TaskFailure):
+            del self.queued_files[task["file"].id]
+            self.n_processed += 1
+            print("Unable to fetch file {}/{}: {}".format(self.n_processed, self.n_pending,
+                    result.exception))
+            self.failed_files.append(task["file"])
+            return
+
+        self.file_fetched(task["file"], task["path"])
+        self.commit(force=False)
+
+    def file_fetched(self, file, file_path):
+        del self.queued_files[file.id]
+        self.n_processed += 1
+        print("Fetched file {}/{}: {}".format(self.n_processed, self.n_pending,
+                ellipsize(file.description, 50)))
+        self.session.set_file_fetched(file, file_path)
+        self.fetched_files.append(file)
+        if self.on_fetched:
+            self.on_fetched(file)
+
+    def commit(self, force=True):
+        # Files whose local date is lost in a crash are fetched again by the next run
+        if not self.fetched_files or (not force
+                and len(self.fetched_files) < self.commit_interval):
+            return
+        self.db.set_local_dates(self.fetched_files)
+        if self.on_commit:
+            self.on_commit()
+        self.db.commit()
+        self.fetched_files = []
+
+    def report(self):
+        if self.failed_files:
+            print("\n{} file(s) could not be fetched and will be retried during the next"
+                    " fetch:".format(len(self.failed_files)))
+            for file in self.failed_files:
+                print("  " + ellipsize(file.description, 70))
 
 
 class Session:
@@ -52,57 +619,155 @@ class Session:
         return self.config["server", "studip_base"] + url
 
 
-    def __init__(self, config, db, user_name, password, sync_dir):
+    def __init__(self, config, db, user_name, password, sync_dir, cookies=None,
+            ask_password=None):
         self.db = db
         self.config = config
         self.sync_dir = sync_dir
+        self.user_name = user_name
+        self.password = password
+        self.ask_password = ask_password
+        self.password_lock = Lock()
+
+        for key in [ "file_list_parser", "file_details_parser" ]:
+            if self.config["update", key] not in PARSER_BACKENDS:
+                raise SessionError("Invalid {}: {}, must be one of {}".format(key,
+                        self.config["update", key], ", ".join(PARSER_BACKENDS)))
+        self.parse_file_list_details = partial(parse_file_list_details,
+                backend=self.config["update", "file_list_parser"])
+        self.parse_file_details = partial(parse_file_details,
+                backend=self.config["update", "file_details_parser"])
+
+        limiter = None
+        if self.config["connection", "adaptive_concurrency"]:
+            limiter = AdaptiveLimiter(int(self.config["connection", "initial_concurrency"]),
+                    int(self.config["connection", "max_concurrency"]))
+        self.throttle = Throttle(limiter,
+                float(self.config["connection", "max_requests_per_second"]),
+                float(self.config["connection", "max_bytes_per_second"]),
+                timeout=(float(self.config["connection", "connect_timeout"]),
+                        float(self.config["connection", "read_timeout"])),
+                retries=int(self.config["connection", "retries"]))
+
+        self.http = ThrottledSession(self.throttle)
+        # The downloads of all workers go through the main session
+        n_connections = max(requests.adapters.DEFAULT_POOLSIZE,
+                int(self.config["connection", "fetch_concurrency"]) + 1)
+        for prefix in [ "http://", "https://" ]:
+            self.http.mount(prefix, requests.adapters.HTTPAdapter(pool_maxsize=n_connections))
+        if cookies is not None:
+            for c in cookies:
+                self.http.cookies.set_cookie(requests.cookies.create_cookie(**c))
+
+        self.http_cache = HttpCache(path.join(self.sync_dir, ".studip", "http-cache"))
+        if self.db.created or self.db.migrated:
+            # Cached pages refer to the contents of the previous database
+            self.http_cache.clear()
+
+        # A session restored from a previous run only needs to be renewed once it has expired
+        if cookies is None or not self.probe(self.http):
+            self.authenticate(self.http)
+
+        # Started on first use, workers log in once they need a course context
+        self.workers = None
+        self.parser_pool = ParserPool(int(self.config["update", "parse_processes"]))
+
+
+    def get_workers(self):
+        if self.workers is None:
+            # Scans and downloads each have threads of their own, see TaskLimit
+            n_threads = max(1, int(self.config["connection", "scan_concurrency"])) \
+                    + max(1, int(self.config["connection", "fetch_concurrency"]))
+            self.workers = WorkerPool(self, n_threads,
+                    int(self.config["connection", "update_concurrency"]))
+        return self.workers
+
+
+    def close(self, drain=True):
+        """Stops the worker pool. Unless drain is True, queued requests are dropped and running
+        downloads are interrupted at their next checkpoint."""
+        if self.workers is not None:
+            workers = self.workers
+            self.workers = None
+            workers.close(drain)
+        self.parser_pool.close()
 
-        self.http = requests.session()
 
+    def parse_page(self, function, response, *args):
+        encoding = response.encoding or response.apparent_encoding
+        return self.parser_pool.parse(function, response.content, encoding, *args)
+
+
+    def probe(self, http):
         try:
-            r = self.http.get(self.studip_url("/studip/index.php?again=yes&sso=shib"))
-        except RequestException as e:
-            raise_fetch_error("login page", e)
+            r = http.get(self.studip_url("/studip/dispatch.php/my_courses"),
+                    allow_redirects=False)
+        except RequestException:
+            return False
+        return r.status_code == 200 and "logout.php" in r.text
+
+
+    def export_cookies(self):
+        return [ { "name": c.name, "value": c.value, "domain": c.domain, "path": c.path,
+                "secure": c.secure, "expires": c.expires } for c in self.http.cookies ]
+
 
+    def get_password(self, interactive=True):
+        # The password is only asked for once a login is actually required
+        with self.password_lock:
+            if self.password is None and interactive and self.ask_password is not None:
+                self.password = self.ask_password()
+        if self.password is None:
+            raise LoginError("Login required, but no password is available")
+        return self.password
+
+
+    def authenticate(self, http, interactive=True):
         try:
-            form_data = parse_login_form(r.text)
-        except ParserError:
-            raise LoginError("Error parsing login page")
-
-        try:
-            r = self.http.post(
-                    self.sso_url(form_data.post_url),
-                    data = {
-                        "j_username": user_name,
-                        "j_password": password,
-                        "uApprove.consent-revocation": "",
-                        "_eventId_proceed": ""
-                    }
-                )
+            r = http.get(self.studip_url("/studip/index.php?again=yes&sso=shib"))
         except RequestException as e:
-            raise_fetch_error("login confirmation page", e)
+            raise_fetch_error("login page", e)
 
+        # With an existing SSO session, the identity provider answers with the SAML form right
+        # away, which is the case for every worker session after the initial login
         try:
             form_data = parse_saml_form(r.text)
-        except ParserError as e:
-            message = "Login failed"
-            if e.message:
-                message += ": " + e.message
-            raise LoginError(message)
+        except ParserError:
+            try:
+                form_data = parse_login_form(r.text)
+            except ParserError:
+                raise LoginError("Error parsing login page")
 
-        try:
-            r = self.http.post(self.studip_url("/Shibboleth.sso/SAML2/POST"), form_data)
-        except RequestException as e:
-            raise_fetch_error("login page", e)
+            try:
+                r = http.post(
+                        self.sso_url(form_data.post_url),
+                        data = {
+                            "j_username": self.user_name,
+                            "j_password": self.get_password(interactive),
+                            "uApprove.consent-revocation": "",
+                            "_eventId_proceed": ""
+                        }
+                    )
+            except RequestException as e:
+                raise_fetch_error("login confirmation page", e)
 
+            try:
+                form_data = parse_saml_form(r.text)
+            except ParserError as e:
+                message = "Login failed"
+                if e.message:
+                    message += ": " + e.message
+                raise LoginError(message)
 
-    def update_metadata(self):
-        url = self.studip_url("/studip/dispatch.php/my_courses/set_semester")
         try:
-            overview_page = self.http.post(url, data={ "sem_select": "current" }).text
+            r = http.post(self.studip_url("/Shibboleth.sso/SAML2/POST"), form_data)
         except RequestException as e:
-            raise_fetch_error("overview page", e)
+            raise_fetch_error("login page", e)
+
 
+    def update_course_list(self, overview_page):
+        """Updates the semesters and courses from the overview page, asking about new and
+        removed courses. Returns the FileIndicator of each course by course id."""
         try:
             semester_list = parse_semester_list(overview_page)
         except ParserError:
@@ -111,7 +776,7 @@ class Session:
         self.db.update_semester_list(semester_list.semesters)
 
         try:
-            remote_courses = parse_course_list(overview_page)
+            remote_courses, file_indicators = parse_course_list_and_file_indicators(overview_page)
         except ParserError:
             raise SessionError("Unable to parse course list")
 
@@ -143,113 +808,337 @@ class Session:
                 course.sync = { "y" : SyncMode.Full, "n" : SyncMode.NoSync }[sync]
             self.db.add_course(course)
 
-        sync_courses = self.db.list_courses(full=True, select_sync_no=False)
-        last_course_synced = False
-        db_files = self.db.list_files(full=True, select_sync_yes=True,
-                select_sync_metadata_only=True, select_sync_no=False)
-        db_file_dict = dict((f.id, f) for f in db_files)
-
-        concurrency = int(self.config["connection", "update_concurrency"])
-        with SessionPool(concurrency, self.http.cookies) as pool:
-            for course in sync_courses:
-                course_url = self.studip_url("/studip/seminar_main.php?auswahl=" + course.id)
-                folder_url = self.studip_url("/studip/folder.php?cid=" + course.id + "&cmd=all")
-
-                try:
-                    self.http.get(course_url, timeout=(None, 0.001))
-                except (KeyboardInterrupt, SystemExit):
-                    raise
-                except Timeout:
-                    pass
-                except RequestException as e:
-                    raise SessionError("Unable to set course: {}".format(str(e)))
-
-                r = self.http.get(folder_url)
-                try:
-                    file_list = parse_file_list(r.text)
-                except ParserError:
-                    raise SessionError("Unable to parse file list")
-
-                if last_course_synced:
-                    print()
-
-                new_files = [ file_id for file_id, _ in file_list if file_id not in db_file_dict ]
-                updated_files = [ file_id for file_id, date in file_list
-                        if file_id  in db_file_dict and db_file_dict[file_id].remote_date != date ]
-
-                if len(new_files) > 0:
-                    new_files_str = ("" if last_course_synced else "\n") + str(len(new_files))
-                    last_course_synced = True
+        return file_indicators
+
+
+    def run_tasks(self, pool, handlers):
+        """Processes the results of the current batch of the pool in the order the tasks
+        complete, by calling handlers[task["run"]](task, result) in this thread. Handlers may
+        defer further tasks, which become part of the same batch."""
+        pool.done()
+        for future in pool.futures():
+            task = future.task
+            handlers[task["run"]](task, future.outcome())
+            pool.done()
+
+
+    def update_metadata(self):
+        update = MetadataUpdate(self)
+        if update.sync_courses:
+            pool = self.get_workers()
+            update.defer_scans(pool)
+            self.run_tasks(pool, update.handlers())
+        update.report()
+
+
+    def needs_scan(self, indicator, state, now):
+        """Decides whether the folder page of a course must be fetched, based on its files icon
+        on the overview page and the state recorded when the folder page was last processed"""
+        if indicator is None or state is None or indicator.new:
+            return True
+        if indicator.state != state.files_state:
+            # The number of files has changed
+            return True
+        # Changes the icon does not show, like updated files, are found by a periodic full crawl
+        interval = float(self.config["update", "full_crawl_interval"])
+        return now - state.crawled >= timedelta(hours=interval)
+
+
+    def run_course_scan(self, local_state, task):
+        with self.workers.course_session(local_state) as (http, detail_pool):
+            return self.scan_course(http, detail_pool, task["course"], task["db_file_dict"],
+                    task["folder_page"])
+
+
+    def scan_course(self, http, detail_pool, course, db_file_dict, folder_page):
+        """Returns the files of a course that are new or have been updated since the last time
+        its folder page, which is given by folder_page, was processed"""
+        course_url = self.studip_url("/studip/seminar_main.php?auswahl=" + course.id)
+        folder_url = self.studip_url("/studip/folder.php?cid=" + course.id + "&cmd=all")
+
+        try:
+            # Only the server-side effect is needed. The body is not read, because a timeout
+            # while reading it would not be reported as a Timeout. Connecting may still time out.
+            http.get(course_url, timeout=(self.throttle.timeout[0], 0.001), stream=True,
+                    retry=False).close()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except ReadTimeout:
+            pass
+        except RequestException as e:
+            raise SessionError("Unable to set course: {}".format(str(e)))
+
+        # Without a previous response to compare against, the page is parsed while it is being
+        # received, so the details of the first files are already fetched during the transfer
+        stream = self.parser_pool.inline and folder_page is None
+        try:
+            # Without a processed page, a "304 Not Modified" response would be of no use
+            folder = self.http_cache.request(http, "GET", folder_url, stream=stream,
+                    validate=folder_page is not None)
+        except RequestException as e:
+            raise_fetch_error("file list", e)
+
+        new_files = []
+        updated_files = []
+        files = []
+        def add_listed_files(listed_files):
+            for file in listed_files:
+                if file.id not in db_file_dict:
+                    new_files.append(file.id)
+                elif db_file_dict[file.id].remote_date != file.remote_date:
+                    updated_files.append(file.id)
                 else:
-                    new_files_str = "No"
-                    last_course_synced = False
-
-                updated_files_str = ""
-                if len(updated_files) > 0:
-                    updated_files_str = ", {} updated ".format(len(updated_files))
-
-                print("{} new{} file(s) for {} {} ".format(new_files_str, updated_files_str,
-                        course.type, course.name))
-
-                files_to_fetch = new_files + updated_files
-                for file_id in files_to_fetch:
-                    pool.defer_request("GET", folder_url + "&open=" + file_id)
-                pool.done()
-
-                for i, request in enumerate(pool):
-                    try:
-                        file = parse_file_details(course.id, request.text)
-                    except ParserError:
-                        raise SessionError("Unable to parse file details")
-
-                    print("Fetched metadata for file {}/{}: ".format(i+1, len(files_to_fetch)),
-                            end="", flush=True)
-                    if file.complete():
-                        if file.id in new_files:
-                            self.db.add_file(file)
-                        else:
-                            self.db.update_file(file)
-                        print(" " + file.description)
-                    else:
-                        print(" <bad format>")
+                    continue
+                # Files whose details are already contained in the file list do not require a
+                # separate request for the details page
+                if file.complete():
+                    files.append(file)
+                else:
+                    detail_pool.defer_request("GET", folder_url + "&open=" + file.id)
 
+        try:
+            if folder.response is None or (folder_page is not None
+                    and folder.entry["digest"] == folder_page.digest):
+                # The page has already been processed, nothing to parse or compare
+                page = None
+            elif stream:
+                page = FolderPage(course.id, None, [])
+                for listed_files in self.stream_file_list(http, folder, course.id):
+                    page.files.extend((f.id, f.remote_date) for f in listed_files)
+                    add_listed_files(listed_files)
+                page.digest = folder.entry["digest"]
+            else:
+                listed_files = self.parse_page(self.parse_file_list_details, folder.response,
+                        course.id)
+                page = FolderPage(course.id, folder.entry["digest"],
+                        [ (f.id, f.remote_date) for f in listed_files ])
+                # Pages often differ only in details like download counters, in which case
+                # the listed files have already been compared against the database
+                if folder_page is None or page.files != folder_page.files:
+                    add_listed_files(listed_files)
+        except RequestException as e:
+            self.discard_details(detail_pool)
+            raise_fetch_error("file list", e)
+        except ParserError:
+            self.discard_details(detail_pool)
+            raise SessionError("Unable to parse file list")
+        except:
+            self.discard_details(detail_pool)
+            raise
+        detail_pool.done()
 
-    def fetch_files(self):
-        first_file = True
-        files_dir = path.join(self.sync_dir, ".studip", "files")
-        os.makedirs(files_dir, exist_ok=True)
+        # A file whose details cannot be fetched does not fail the whole course, it is simply
+        # picked up again during the next update
+        failures = []
+        for request in detail_pool:
+            if isinstance(request, TaskFailure):
+                failures.append("Unable to fetch file details: {}".format(request.exception))
+                continue
+            try:
+                request.raise_for_status()
+                files.append(self.parse_page(self.parse_file_details, request, course.id))
+            except RequestException as e:
+                failures.append("Unable to fetch file details: {}".format(e))
+            except ParserError:
+                failures.append("Unable to parse file details")
 
-        sync_files = self.db.list_files(full=True, select_sync_metadata_only=False,
-                select_sync_no=False)
-        sync_file_paths = ((f, path.join(files_dir, f.id)
-                + ("."  + str(f.version) if f.version > 0 else "")) for f in sync_files)
-        sync_file_updates = ((f, p, path.isfile(p), not f.local_date
-                or f.local_date != f.remote_date) for (f, p) in sync_file_paths)
-        pending_files = [(f, p, exists, update) for (f, p, exists, update) in sync_file_updates
-                if not exists or update]
-
-        for i, (file, file_path, exists, update) in enumerate(pending_files):
-            if first_file:
-                print()
-                first_file = False
-            print("Fetching file {}/{}: {}...".format(i+1, len(pending_files),
-                    ellipsize(file.description, 50)))
-
-            url = self.studip_url("/studip/sendfile.php?force_download=1&type=0&" \
-                    + urlencode({"file_id": file.id, "file_name": file.name }))
+        return CourseScan(course, folder, page, new_files, updated_files, files, failures)
+
+
+    def stream_file_list(self, http, folder, course_id):
+        """Feeds a streamed folder page to the file list parser chunk by chunk, yielding the newly
+        parsed files after each chunk"""
+        parser = get_file_list_parser(self.config["update", "file_list_parser"])()
+        decoder = codecs.getincrementaldecoder(folder.response.encoding or "utf-8")(
+                errors="replace")
+        n_files = 0
+        try:
+            for chunk in folder.iter_content(FOLDER_CHUNK_SIZE):
+                http.throttle.transfer(len(chunk))
+                parser.feed(decoder.decode(chunk))
+                if len(parser.files) > n_files:
+                    yield self.set_course(parser.files[n_files:], course_id)
+                    n_files = len(parser.files)
+            parser.feed(decoder.decode(b"", final=True))
+            parser.close()
+            yield self.set_course(parser.files[n_files:], course_id)
+        finally:
+            folder.response.close()
+
+
+    def set_course(self, files, course_id):
+        for file in files:
+            file.course = course_id
+        return files
+
+
+    def discard_details(self, detail_pool):
+        # Requests that have already been deferred must not end up in the results of the next
+        # course scanned by this worker
+        detail_pool.done()
+        for request in detail_pool:
+            pass
+
+
+    def run_archive_fetch(self, local_state, task):
+        with self.workers.course_session(local_state) as (http, detail_pool):
+            return self.fetch_archive(http, task["course"], task["files"], task["files_dir"],
+                    local_state["aborting"])
+
+
+    def fetch_archive(self, http, course, files, files_dir, aborting):
+        """Fetches several files of a course as a single ZIP archive, like the "download selected
+        files" button on the folder page does. Returns the (file, path) pairs that have been
+        extracted, members that cannot be matched to a file are ignored. Raises TaskAborted
+        once aborting is set, as archives cannot be resumed."""
+        course_url = self.studip_url("/studip/seminar_main.php?auswahl=" + course)
+        folder_url = self.studip_url("/studip/folder.php?cid=" + course + "&cmd=all")
+
+        try:
+            http.get(course_url, timeout=(self.throttle.timeout[0], 0.001), stream=True,
+                    retry=False).close()
+        except ReadTimeout:
+            pass
+
+        data = [ ("download_ids[]", file.id) for (file, file_path) in files ]
+        data.append(("download_selected", "1"))
+
+        with tempfile.TemporaryFile(dir=files_dir) as archive_file:
+            r = http.post(folder_url, data=data, stream=True)
             try:
-                r = self.http.get(url)
+                r.raise_for_status()
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    if aborting.is_set():
+                        raise TaskAborted()
+                    self.throttle.transfer(len(chunk))
+                    archive_file.write(chunk)
+            finally:
+                r.close()
+
+            archive_file.seek(0)
+            if not zipfile.is_zipfile(archive_file):
+                raise SessionError("Server did not return a ZIP archive")
+
+            # Stud.IP stores the plain file names, so they are only usable if they are unique
+            files_by_name = {}
+            for file, file_path in files:
+                file_name = file.name + ("." + file.extension if file.extension else "")
+                files_by_name.setdefault(normalize_member_name(file_name), []).append(
+                        (file, file_path))
+
+            extracted = []
+            with zipfile.ZipFile(archive_file) as archive:
+                for member in archive.infolist():
+                    if member.filename.endswith("/"):
+                        continue
+                    matches = files_by_name.pop(
+                            normalize_member_name(get_member_name(member)), [])
+                    if len(matches) != 1:
+                        continue
+                    file, file_path = matches[0]
+                    # Replaces any partial download left over from fetching the file separately
+                    partial = PartialDownload(file_path, file.remote_date)
+                    partial.discard()
+                    with archive.open(member) as source, open(partial.part_path, "wb") as dest:
+                        shutil.copyfileobj(source, dest, DOWNLOAD_CHUNK_SIZE)
+                        dest.flush()
+                        os.fsync(dest.fileno())
+                    os.replace(partial.part_path, file_path)
+                    extracted.append((file, file_path))
+
+        return extracted
+
+
+    def run_file_fetch(self, local_state, task):
+        # Downloads do not depend on the course context, so they share the main session
+        retries = self.throttle.retries
+        for attempt in range(retries + 1):
+            partial = PartialDownload(task["path"], task["file"].remote_date)
+            try:
+                download_file(self.http, task["url"], partial, local_state["aborting"])
+                break
             except RequestException as e:
-                raise SessionError("Unable to download file {}: {}".format(file.name, e))
+                # Like ThrottledSession, only retry if the server might answer differently later
+                response = e.response if isinstance(e, HTTPError) else None
+                if attempt == retries or (response is not None
+                        and not is_server_error(response)):
+                    raise SessionError("Unable to download file {}: {}".format(
+                            task["file"].name, e))
+            time.sleep((response is not None and get_retry_after(response))
+                    or backoff_delay(attempt))
 
-            with open(file_path, "wb") as writer:
-                writer.write(r.content)
+        # The data has been fsync'ed by the last checkpoint, so the rename is atomic and durable
+        partial.finish(task["path"])
+        return task
 
-            file.local_date = file.remote_date
 
-            timestamp = time.mktime(file.local_date.timetuple())
-            os.utime(file_path, (timestamp, timestamp))
+    def set_file_fetched(self, file, file_path):
+        file.local_date = file.remote_date
 
-            self.db.update_file_local_date(file)
-            self.db.commit()
+        timestamp = time.mktime(file.local_date.timetuple())
+        os.utime(file_path, (timestamp, timestamp))
+
+
+    def fetch_files(self):
+        fetch = FileFetch(self)
+        pending_files = fetch.list_pending_files()
+        if pending_files:
+            pool = self.get_workers()
+            fetch.add_files(pool, pending_files)
+            try:
+                self.run_tasks(pool, fetch.handlers())
+            finally:
+                fetch.commit()
+        fetch.report()
+
+
+    def sync(self, open_views):
+        """Runs update, fetch and checkout as a pipeline. Each file is fetched as soon as its
+        metadata has been stored and checked out into the views returned by open_views() as soon
+        as it has been fetched, while other courses are still being scanned."""
+        update = MetadataUpdate(self)
+        views = open_views()
+        for view in views:
+            view.checkout_pending()
+
+        def checkout_file(file):
+            for view in views:
+                view.checkout_file(file)
+        def store_checkouts():
+            for view in views:
+                view.store_checkouts()
+        fetch = FileFetch(self, on_fetched=checkout_file, on_commit=store_checkouts)
+
+        pending_files = fetch.list_pending_files()
+        try:
+            if update.sync_courses or pending_files:
+                pool = self.get_workers()
+                update.on_files_stored = lambda files: fetch.add_files(pool,
+                        fetch.get_file_paths(files))
+
+                # Downloads left over from previous runs are started right away, unless their
+                # course is scanned first, which may find a newer version of them
+                held_files = dict((course.id, []) for course in update.sync_courses)
+                started_files = []
+                for file, file_path in pending_files:
+                    if file.course in held_files:
+                        held_files[file.course].append((file, file_path))
+                    else:
+                        started_files.append((file, file_path))
+                fetch.add_files(pool, started_files)
+                def scan_completed(task, scan):
+                    update.scan_completed(task, scan)
+                    fetch.add_files(pool, held_files.pop(task["course"].id))
+
+                update.defer_scans(pool)
+                handlers = update.handlers()
+                handlers[self.run_course_scan] = scan_completed
+                handlers.update(fetch.handlers())
+                self.run_tasks(pool, handlers)
+        finally:
+            fetch.commit()
+            for view in views:
+                view.finish()
 
+        update.report()
+        fetch.report()
@@ -0,0 +1,17 @@
+BEGIN TRANSACTION;
+
+CREATE TABLE folder_pages (
+    course CHAR(32) NOT NULL,
+    digest CHAR(64) NOT NULL,
+    files TEXT NOT NULL,
+    PRIMARY KEY (course ASC),
+    FOREIGN KEY (course) REFERENCES courses(id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER cleanup_folder_pages_courses
+BEFORE DELETE ON courses
+BEGIN
+    DELETE FROM folder_pages WHERE course = old.id;
+END;
+
+COMMIT TRANSACTION;
@@ -0,0 +1,17 @@
+BEGIN TRANSACTION;
+
+CREATE TABLE course_states (
+    course CHAR(32) NOT NULL,
+    files_state VARCHAR(128),
+    crawled TIMESTAMP NOT NULL,
+    PRIMARY KEY (course ASC),
+    FOREIGN KEY (course) REFERENCES courses(id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER cleanup_course_states_courses
+BEFORE DELETE ON courses
+BEGIN
+    DELETE FROM course_states WHERE course = old.id;
+END;
+
+COMMIT TRANSACTION;
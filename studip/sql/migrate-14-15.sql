@@ -0,0 +1,83 @@
+BEGIN TRANSACTION;
+
+-- The folder_paths view is replaced by a table of the same name that is kept up to date by
+-- triggers, so it is filled from the view before the view is dropped
+
+CREATE TABLE folder_paths_migrate (
+    folder INTEGER NOT NULL,
+    course CHAR(32),
+    path TEXT NOT NULL,
+    PRIMARY KEY (folder ASC),
+    FOREIGN KEY (folder) REFERENCES folders(id)
+);
+
+INSERT INTO folder_paths_migrate (folder, course, path)
+SELECT folder, course, path
+FROM folder_paths;
+
+DROP VIEW file_details;
+DROP VIEW folder_paths;
+DROP VIEW folder_parents;
+
+CREATE TABLE folder_paths (
+    folder INTEGER NOT NULL,
+    course CHAR(32),
+    path TEXT NOT NULL,
+    PRIMARY KEY (folder ASC),
+    FOREIGN KEY (folder) REFERENCES folders(id)
+);
+
+INSERT INTO folder_paths (folder, course, path)
+SELECT folder, course, path
+FROM folder_paths_migrate;
+
+DROP TABLE folder_paths_migrate;
+
+CREATE TRIGGER add_folder_path
+AFTER INSERT ON folders
+BEGIN
+    INSERT INTO folder_paths (folder, course, path)
+    SELECT new.id, NULL, '[]'
+    WHERE new.parent IS NULL;
+
+    -- Appends the escaped name to the string representation of the parent's path
+    INSERT INTO folder_paths (folder, course, path)
+    SELECT new.id, p.course, SUBSTR(p.path, 1, LENGTH(p.path) - 1)
+            || CASE WHEN p.path = '[]' THEN '' ELSE ', ' END
+            || '"' || REPLACE(REPLACE(new.name, '\', '\\'), '"', '\"') || '"]'
+    FROM folder_paths AS p
+    WHERE p.folder = new.parent;
+END;
+
+CREATE TRIGGER remove_folder_path
+AFTER DELETE ON folders
+BEGIN
+    DELETE FROM folder_paths WHERE folder = old.id;
+END;
+
+-- Paths of subfolders are derived from their parents once, so folders must stay where they are
+CREATE TRIGGER keep_folder_paths
+BEFORE UPDATE OF name, parent ON folders
+BEGIN
+    SELECT RAISE(ABORT, 'Folders cannot be renamed or moved');
+END;
+
+CREATE TRIGGER set_folder_path_course
+AFTER UPDATE OF root ON courses WHEN new.root IS NOT NULL
+BEGIN
+    UPDATE folder_paths SET course = new.id WHERE folder = new.root;
+END;
+
+CREATE VIEW file_details AS
+    SELECT f.id AS id, c.id AS course_id, s.name AS course_semester, c.name AS course_name,
+            c.abbrev AS course_abbrev, c.type AS course_type, c.type_abbrev as course_type_abbrev,
+            p.path AS path, f.name AS name, f.extension AS extension,
+            f.author AS author, f.description AS description, f.remote_date AS remote_date,
+            f.copyrighted AS copyrighted, f.local_date as local_date, f.version AS version,
+            c.sync AS sync
+    FROM files AS f
+    INNER JOIN folder_paths AS p ON f.folder = p.folder
+    INNER JOIN courses AS c ON p.course = c.id
+    INNER JOIN semesters AS s ON c.semester = s.id;
+
+COMMIT TRANSACTION;
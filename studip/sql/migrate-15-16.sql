@@ -0,0 +1,46 @@
+BEGIN TRANSACTION;
+
+-- Paths are re-encoded from the names of the folders, starting at the root folders
+
+CREATE TEMP TABLE folder_paths_migrate (
+    folder INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (folder ASC)
+);
+
+INSERT INTO folder_paths_migrate (folder, path)
+WITH RECURSIVE paths (folder, path) AS (
+    SELECT id, ''
+        FROM folders
+        WHERE parent IS NULL
+    UNION ALL
+    SELECT folders.id, CASE WHEN paths.path = '' THEN folders.name
+            ELSE paths.path || CHAR(31) || folders.name END
+        FROM folders
+        INNER JOIN paths ON folders.parent = paths.folder
+)
+SELECT folder, path FROM paths;
+
+UPDATE folder_paths
+SET path = (SELECT path FROM folder_paths_migrate
+        WHERE folder_paths_migrate.folder = folder_paths.folder);
+
+DROP TABLE folder_paths_migrate;
+
+DROP TRIGGER add_folder_path;
+
+CREATE TRIGGER add_folder_path
+AFTER INSERT ON folders
+BEGIN
+    INSERT INTO folder_paths (folder, course, path)
+    SELECT new.id, NULL, ''
+    WHERE new.parent IS NULL;
+
+    INSERT INTO folder_paths (folder, course, path)
+    SELECT new.id, p.course, CASE WHEN p.path = '' THEN new.name
+            ELSE p.path || CHAR(31) || new.name END
+    FROM folder_paths AS p
+    WHERE p.folder = new.parent;
+END;
+
+COMMIT TRANSACTION;
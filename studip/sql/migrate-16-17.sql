@@ -0,0 +1,5 @@
+BEGIN TRANSACTION;
+
+CREATE INDEX IF NOT EXISTS folders_parent_name ON folders (parent, name);
+
+COMMIT TRANSACTION;
@@ -56,6 +56,50 @@ CREATE TABLE IF NOT EXISTS folders (
     CHECK ((name IS NULL) == (parent IS NULL))
 );
 
+CREATE INDEX IF NOT EXISTS folders_parent_name ON folders (parent, name);
+
+-- The path of every folder as the folder names separated by CHAR(31), and its course
+CREATE TABLE IF NOT EXISTS folder_paths (
+    folder INTEGER NOT NULL,
+    course CHAR(32),
+    path TEXT NOT NULL,
+    PRIMARY KEY (folder ASC),
+    FOREIGN KEY (folder) REFERENCES folders(id)
+);
+
+CREATE TRIGGER IF NOT EXISTS add_folder_path
+AFTER INSERT ON folders
+BEGIN
+    INSERT INTO folder_paths (folder, course, path)
+    SELECT new.id, NULL, ''
+    WHERE new.parent IS NULL;
+
+    INSERT INTO folder_paths (folder, course, path)
+    SELECT new.id, p.course, CASE WHEN p.path = '' THEN new.name
+            ELSE p.path || CHAR(31) || new.name END
+    FROM folder_paths AS p
+    WHERE p.folder = new.parent;
+END;
+
+CREATE TRIGGER IF NOT EXISTS remove_folder_path
+AFTER DELETE ON folders
+BEGIN
+    DELETE FROM folder_paths WHERE folder = old.id;
+END;
+
+-- Paths of subfolders are derived from their parents once, so folders must stay where they are
+CREATE TRIGGER IF NOT EXISTS keep_folder_paths
+BEFORE UPDATE OF name, parent ON folders
+BEGIN
+    SELECT RAISE(ABORT, 'Folders cannot be renamed or moved');
+END;
+
+CREATE TRIGGER IF NOT EXISTS set_folder_path_course
+AFTER UPDATE OF root ON courses WHEN new.root IS NOT NULL
+BEGIN
+    UPDATE folder_paths SET course = new.id WHERE folder = new.root;
+END;
+
 CREATE TRIGGER IF NOT EXISTS create_root_folder
 AFTER INSERT ON courses WHEN new.root IS NULL
 BEGIN
@@ -64,6 +108,36 @@ BEGIN
     UPDATE courses SET root = last_insert_rowid() WHERE id = new.id;
 END;
 
+-- The digest and the (id, remote_date) list of files of the last processed folder page
+CREATE TABLE IF NOT EXISTS folder_pages (
+    course CHAR(32) NOT NULL,
+    digest CHAR(64) NOT NULL,
+    files TEXT NOT NULL,
+    PRIMARY KEY (course ASC),
+    FOREIGN KEY (course) REFERENCES courses(id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS cleanup_folder_pages_courses
+BEFORE DELETE ON courses
+BEGIN
+    DELETE FROM folder_pages WHERE course = old.id;
+END;
+
+-- The files icon of the overview page at the time the folder page was last processed
+CREATE TABLE IF NOT EXISTS course_states (
+    course CHAR(32) NOT NULL,
+    files_state VARCHAR(128),
+    crawled TIMESTAMP NOT NULL,
+    PRIMARY KEY (course ASC),
+    FOREIGN KEY (course) REFERENCES courses(id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS cleanup_course_states_courses
+BEFORE DELETE ON courses
+BEGIN
+    DELETE FROM course_states WHERE course = old.id;
+END;
+
 CREATE TABLE IF NOT EXISTS checkouts (
     view INTEGER NOT NULL,
     file id CHAR(32) NOT NULL,
@@ -84,31 +158,6 @@ BEGIN
     DELETE FROM checkouts WHERE file = old.id;
 END;
 
-CREATE VIEW IF NOT EXISTS folder_parents AS
-    WITH RECURSIVE parents (folder, level, this, parent) AS (
-        SELECT id, 0, id, parent
-            FROM folders
-        UNION ALL
-        SELECT parents.folder, parents.level + 1, folders.id, folders.parent
-            FROM folders
-            INNER JOIN parents ON folders.id = parents.parent
-    )
-    SELECT folder, level, this FROM parents;
-
-CREATE VIEW IF NOT EXISTS folder_paths AS
-    SELECT list.folder AS folder,
-        MAX(courses.id) AS course,
-        '[' || IFNULL(GROUP_CONCAT('"' || REPLACE(REPLACE(folders.name, '\', '\\'),
-            '"', '\"') || '"', ', '), '') || ']' AS path
-    FROM (
-        SELECT parents.folder AS folder, parents.this AS this
-        FROM folder_parents AS parents
-        ORDER BY level DESC
-    ) AS list
-    INNER JOIN folders ON folders.id = list.this
-    LEFT OUTER JOIN courses ON courses.root = folders.id
-    GROUP BY folder;
-
 CREATE VIEW IF NOT EXISTS file_details AS
     SELECT f.id AS id, c.id AS course_id, s.name AS course_semester, c.name AS course_name,
             c.abbrev AS course_abbrev, c.type AS course_type, c.type_abbrev as course_type_abbrev,
@@ -0,0 +1,194 @@
+import time, random, requests
+
+from threading import Lock, Condition
+from requests import RequestException, Timeout
+
+# A request is considered a sign of congestion if it takes this much longer than the fastest one
+LATENCY_TOLERANCE = 4
+LATENCY_SLACK = 0.5
+# Multiple congested requests within this interval only cause a single decrease
+DECREASE_INTERVAL = 1.0
+# Retries wait for a random time of up to BACKOFF_BASE * 2^attempt, but at most BACKOFF_MAX
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+IDEMPOTENT_METHODS = [ "GET", "HEAD", "OPTIONS" ]
+
+
+def backoff_delay(attempt):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def is_server_error(response):
+    return response.status_code == 429 or response.status_code >= 500
+
+
+def get_retry_after(response):
+    try:
+        return min(BACKOFF_MAX, float(response.headers["Retry-After"]))
+    except (KeyError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.time = time.monotonic()
+        self.lock = Lock()
+
+    def consume(self, amount):
+        # Tokens are reserved right away, possibly going into debt, and the caller sleeps until
+        # the debt would have been paid off. This keeps the lock from being held while waiting.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.time) * self.rate)
+            self.time = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AdaptiveLimiter:
+    """Limits the number of simultaneous requests, adjusting the limit by additive increase and
+    multiplicative decrease (AIMD) based on request latency and server errors."""
+
+    def __init__(self, initial, maximum, minimum=1):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.active = 0
+        self.min_latency = None
+        self.last_decrease = 0
+        self.peak = self.limit
+        self.cv = Condition()
+
+    def acquire(self):
+        with self.cv:
+            self.cv.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+
+    def release(self):
+        with self.cv:
+            self.active -= 1
+            self.cv.notify_all()
+
+    def record(self, latency, congested=False):
+        with self.cv:
+            if not congested:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                congested = latency > LATENCY_TOLERANCE * self.min_latency + LATENCY_SLACK
+
+            now = time.monotonic()
+            if congested:
+                if now - self.last_decrease > DECREASE_INTERVAL:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self.peak = max(self.peak, self.limit)
+            self.cv.notify_all()
+
+    @property
+    def concurrency(self):
+        return int(self.limit)
+
+
+class Throttle:
+    def __init__(self, limiter=None, requests_per_second=0, bytes_per_second=0, timeout=None,
+            retries=0):
+        self.limiter = limiter
+        self.timeout = timeout
+        self.retries = retries
+        self.request_bucket = TokenBucket(requests_per_second) if requests_per_second else None
+        self.byte_bucket = TokenBucket(bytes_per_second) if bytes_per_second else None
+
+    def begin_request(self):
+        if self.request_bucket:
+            self.request_bucket.consume(1)
+        if self.limiter:
+            self.limiter.acquire()
+        return time.monotonic()
+
+    def record_request(self, start, response=None, failed=False):
+        if self.limiter:
+            congested = failed or is_server_error(response)
+            self.limiter.record(time.monotonic() - start, congested)
+
+    def end_request(self):
+        if self.limiter:
+            self.limiter.release()
+
+    def transfer(self, n_bytes):
+        if self.byte_bucket:
+            self.byte_bucket.consume(n_bytes)
+
+
+class ThrottledSession(requests.Session):
+    """A requests session that applies the timeouts, retries and limits of a Throttle. Retries can
+    be disabled per request by passing retry=False."""
+
+    def __init__(self, throttle):
+        super().__init__()
+        self.throttle = throttle
+
+    def request(self, method, url, *args, retry=True, **kwargs):
+        if self.throttle.timeout is not None:
+            kwargs.setdefault("timeout", self.throttle.timeout)
+
+        attempts = 1
+        if retry and method.upper() in IDEMPOTENT_METHODS:
+            attempts += self.throttle.retries
+
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            try:
+                r = self.throttled_request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, Timeout):
+                if last_attempt:
+                    raise
+                delay = backoff_delay(attempt)
+            else:
+                if last_attempt or not is_server_error(r):
+                    return r
+                delay = get_retry_after(r) or backoff_delay(attempt)
+                r.close()
+            time.sleep(delay)
+
+    def throttled_request(self, method, url, *args, stream=False, **kwargs):
+        start = self.throttle.begin_request()
+        try:
+            # The body is always read afterwards, so that the latency does not include the time
+            # spent transferring large pages
+            r = super().request(method, url, *args, stream=True, **kwargs)
+        except Timeout:
+            # Timeouts can be intentional, so they are no indication of server load
+            self.throttle.end_request()
+            raise
+        except RequestException:
+            self.throttle.record_request(start, failed=True)
+            self.throttle.end_request()
+            raise
+        except BaseException:
+            self.throttle.end_request()
+            raise
+
+        self.throttle.record_request(start, r)
+        if stream:
+            # The request keeps its slot until the body has been transferred and the response
+            # is closed. The caller accounts for the transferred bytes.
+            close = r.close
+            released = []
+            def close_and_release():
+                close()
+                if not released:
+                    released.append(True)
+                    self.throttle.end_request()
+            r.close = close_and_release
+        else:
+            try:
+                self.throttle.transfer(len(r.content))
+            finally:
+                self.throttle.end_request()
+        return r
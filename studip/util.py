@@ -1,4 +1,4 @@
-import re
+import os, re, hmac, hashlib
 
 from base64 import b64encode, b64decode
 from enum import IntEnum
@@ -65,6 +65,44 @@ def decrypt_password(secret, crypt):
         return None
 
 
+def derive_key(secret, purpose):
+    return hmac.new(secret, purpose.encode("ascii"), hashlib.sha256).digest()
+
+
+def keystream(key, nonce, length):
+    # HMAC-SHA256 in counter mode
+    blocks = (hmac.new(key, nonce + counter.to_bytes(8, "big"), hashlib.sha256).digest()
+            for counter in range((length + 31) // 32))
+    return b"".join(blocks)[:length]
+
+
+def encrypt_data(secret, data):
+    """Encrypts and authenticates data with keys derived from the secret, so that known parts of
+    the data, such as cookie names, do not reveal the secret that also encrypts the password"""
+    nonce = os.urandom(16)
+    plain = data.encode("utf-8")
+    cipher = bytes(xor_bytes(keystream(derive_key(secret, "data encryption"), nonce, len(plain)),
+            plain))
+    tag = hmac.new(derive_key(secret, "data authentication"), nonce + cipher, hashlib.sha256)
+    return b64encode(nonce + cipher + tag.digest()).decode("ascii")
+
+
+def decrypt_data(secret, crypt):
+    try:
+        crypt = b64decode(crypt.encode("ascii"))
+        if len(crypt) < 48:
+            return None
+        nonce, cipher, tag = crypt[:16], crypt[16:-32], crypt[-32:]
+        expected = hmac.new(derive_key(secret, "data authentication"), nonce + cipher,
+                hashlib.sha256).digest()
+        if not hmac.compare_digest(tag, expected):
+            return None
+        return bytes(xor_bytes(keystream(derive_key(secret, "data encryption"), nonce,
+                len(cipher)), cipher)).decode("utf-8")
+    except Exception:
+        return None
+
+
 def compact(str):
     return " ".join(str.split())
 
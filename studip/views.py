@@ -46,6 +46,11 @@ class ViewSynchronizer:
         self.new_files = []
         self.deleted_files = []
 
+        # Checked out files not yet written to the database, see store_checkouts()
+        self.checkouts = []
+        # A file is linked at most once per run, even if several versions of it are fetched
+        self.linked_ids = set()
+
         checked_out_files = self.db.list_checkouts(view.id)
         for f in fetched_files:
             # File is known, but not checked out
@@ -56,10 +61,19 @@ class ViewSynchronizer:
                     self.new_files.append(f)
             # File is checked out, but we don't have a record of it (e.g. after reset-deleted)
             elif f.id not in checked_out_files:
-                self.db.add_checkout(self.view.id, f.id)
+                self.checkouts.append(f.id)
 
+        self.store_checkouts()
         self.db.commit()
 
+        # Files the user has removed from the view are not checked out again by checkout_file()
+        self.deleted_versions = set((f.id, f.version) for f in self.deleted_files)
+
+        # Collected while checking out files, used by finish()
+        self.modified_folders = set()
+        self.copyrighted_files = []
+        self.first_file = True
+
     def __escape_file(self, str):
         return escape_file_name(str, self.view.charset, self.view.escape)
 
@@ -67,77 +81,111 @@ class ViewSynchronizer:
         return path.join(*map(self.__escape_file, folders)) if folders else ""
 
     def checkout(self):
+        try:
+            self.checkout_pending()
+        finally:
+            self.finish()
+
+    def checkout_pending(self):
+        """Checks out all fetched files that are not part of the view yet"""
         if not self.view:
             raise SessionError("View does not exist")
 
-        modified_folders = set()
-        copyrighted_files = []
-
         try:
             pending_files = []
             for file in self.new_files:
-                rel_path = self.format_file_path(file)
-                abs_path = path.join(self.view_dir, rel_path)
-
-                # First update modified_folders, then create directories.
-                folder = path.dirname(rel_path)
-                while folder:
-                    modified_folders.add(folder)
-                    folder = path.dirname(folder)
-
+                rel_path, abs_path = self.add_file_path(file)
                 if not path.isfile(abs_path):
                     pending_files.append((file, rel_path, abs_path))
+            self.new_files = []
 
-            first_file = True
             for i, (file, rel_path, abs_path) in enumerate(pending_files):
-                if first_file:
-                    print()
-                    first_file = False
-                print("Checking out file {}/{}: {}...".format(i+1, len(pending_files),
-                        ellipsize(file.description, 50)))
-
-                if file.copyrighted:
-                    copyrighted_files.append(rel_path)
-
-                file_name = file.id
-                if file.version > 0:
-                    file_name += "." + str(file.version)
-                os.makedirs(path.dirname(abs_path), exist_ok=True)
-                os.link(path.join(self.files_dir, file_name), abs_path)
-                self.db.add_checkout(self.view.id, file.id)
-
+                self.link_file(file, rel_path, abs_path, "{}/{}".format(i+1, len(pending_files)))
         finally:
+            self.store_checkouts()
             self.db.commit()
 
-            modified_folders = list(modified_folders)
-            modified_folders.sort(key=lambda f: len(f), reverse=True)
-
-            def update_directory_mtime(dir):
-                latest_ctime = 0
-                for file in os.listdir(dir):
-                    if not file.startswith("."):
-                        latest_ctime = max(latest_ctime, path.getmtime(dir + "/" + file))
-
-                # This may fail if a directory has not been created yet.
-                try:
-                    os.utime(dir, (latest_ctime, latest_ctime))
-                except Exception:
-                    pass
-
-            for folder in modified_folders:
-                update_directory_mtime(path.join(self.view_dir, folder))
-            if self.view.base:
-                update_directory_mtime(self.view_dir)
-            update_directory_mtime(self.sync_dir)
-
-            if copyrighted_files:
-                print("\n" + "-"*80)
-                print("The following files have special copyright notices:\n")
-                for file in copyrighted_files:
-                    print("  -", file)
-                print("\nPlease make sure you have looked up, read and understood the terms and"
-                        " conditions of these files before proceeding to use them.")
-                print("-"*80 + "\n")
+    def checkout_file(self, file):
+        """Checks out a single file that has just been fetched. The checkout is written by the
+        next call of store_checkouts(), finish() must be called once all files are checked out."""
+        if (file.id, file.version) in self.deleted_versions:
+            return
+        rel_path, abs_path = self.add_file_path(file)
+        if not path.isfile(abs_path):
+            self.link_file(file, rel_path, abs_path, "into view {}".format(self.view.name))
+
+    def add_file_path(self, file):
+        rel_path = self.format_file_path(file)
+        abs_path = path.join(self.view_dir, rel_path)
+
+        # First update modified_folders, then create directories.
+        folder = path.dirname(rel_path)
+        while folder:
+            self.modified_folders.add(folder)
+            folder = path.dirname(folder)
+
+        return rel_path, abs_path
+
+    def link_file(self, file, rel_path, abs_path, progress):
+        if file.id in self.linked_ids:
+            return
+        if self.first_file:
+            print()
+            self.first_file = False
+        print("Checking out file {}: {}...".format(progress, ellipsize(file.description, 50)))
+
+        if file.copyrighted:
+            self.copyrighted_files.append(rel_path)
+
+        file_name = file.id
+        if file.version > 0:
+            file_name += "." + str(file.version)
+        os.makedirs(path.dirname(abs_path), exist_ok=True)
+        os.link(path.join(self.files_dir, file_name), abs_path)
+        self.checkouts.append(file.id)
+        self.linked_ids.add(file.id)
+
+    def store_checkouts(self):
+        self.db.add_checkouts(self.view.id, self.checkouts)
+        self.checkouts = []
+
+    def finish(self):
+        """Updates the modification times of the folders files have been checked out to, and
+        creates folders for courses without files"""
+        self.store_checkouts()
+        self.db.commit()
+
+        modified_folders = list(self.modified_folders)
+        modified_folders.sort(key=lambda f: len(f), reverse=True)
+        self.modified_folders = set()
+
+        def update_directory_mtime(dir):
+            latest_ctime = 0
+            for file in os.listdir(dir):
+                if not file.startswith("."):
+                    latest_ctime = max(latest_ctime, path.getmtime(dir + "/" + file))
+
+            # This may fail if a directory has not been created yet.
+            try:
+                os.utime(dir, (latest_ctime, latest_ctime))
+            except Exception:
+                pass
+
+        for folder in modified_folders:
+            update_directory_mtime(path.join(self.view_dir, folder))
+        if self.view.base:
+            update_directory_mtime(self.view_dir)
+        update_directory_mtime(self.sync_dir)
+
+        if self.copyrighted_files:
+            print("\n" + "-"*80)
+            print("The following files have special copyright notices:\n")
+            for file in self.copyrighted_files:
+                print("  -", file)
+            print("\nPlease make sure you have looked up, read and understood the terms and"
+                    " conditions of these files before proceeding to use them.")
+            print("-"*80 + "\n")
+            self.copyrighted_files = []
 
         # Create course folders for all courses that do not have files yet
         for course in self.db.list_courses(full=True, select_sync_metadata_only=False,